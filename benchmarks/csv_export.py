@@ -0,0 +1,87 @@
+"""Purchases CSV export: paged streaming exporter against the old full download.
+
+    python -m benchmarks.csv_export [--sizes 10000 100000] [--page-size 500]
+
+The fake database sorts the whole node for every page query, so wall time here overstates
+the cost of paging compared to Firebase's key index. Peak memory is the number to watch.
+"""
+import argparse
+import csv
+import io
+import random
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from benchmarks.fake_firebase import FakeDatabase
+from utils.csv_export import CsvExporter
+
+FIELDNAMES = ['customer_name', 'email', 'ticket_name', 'ticket_base_price',
+              'total_amount', 'phone_number',
+              'user', 'user_name', 'user_username',
+              'ticket_description', 'id', 'created',
+              'provider_payment_charge_id', 'telegram_payment_charge_id', 'currency',
+              'issuer_username', 'issuer_name', 'issuer', 'activated']
+
+
+def purchases(count: int) -> dict:
+    started = datetime(2022, 5, 1).timestamp()
+    data = {}
+    for index in range(count):
+        _id = str(uuid.uuid4())
+        data[_id] = {
+            'id': _id, 'created': started + index * 60, 'currency': 'RUB',
+            'customer_name': f'Гость {index}', 'email': f'guest{index}@example.com',
+            'phone_number': '79990000000', 'ticket_name': 'Билет ДММ2022', 'ticket_base_price': 3500,
+            'ticket_description': 'Вход на все дни', 'total_amount': 350000 + random.randint(0, 100) * 100,
+            'user': 100000 + index, 'user_name': f'Гость {index}', 'user_username': f'@guest{index}',
+            'provider_payment_charge_id': _id, 'telegram_payment_charge_id': _id,
+        }
+    return data
+
+
+def legacy_export(ref) -> bytes:
+    # Mirrors the original statistics_csv: one full ordered download, then every row at once
+    fb_purchases = ref.order_by_child("created").get()
+    rows = list(reversed(list(fb_purchases.values())))
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    writer.writerows(rows)
+    return text.getvalue().encode("UTF8")
+
+
+def measure(name, export):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = len(export())
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name}: {elapsed:.2f}s, peak {peak / 2 ** 20:.1f} MiB, output {size / 2 ** 20:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        database = FakeDatabase({"ticket_purchases": purchases(size)})
+        ref = database.reference("ticket_purchases")
+        exporter = CsvExporter(ref, FIELDNAMES, page_size=args.page_size)
+        since = datetime(2022, 5, 4)
+
+        print(f"{size} purchases:")
+        measure("legacy", lambda: legacy_export(ref))
+        measure("streaming", lambda: exporter.export("purchases").getvalue())
+        measure("streaming gzip", lambda: exporter.export("purchases", compress=True).getvalue())
+        measure("streaming 3 columns since May 4",
+                lambda: exporter.export("purchases", columns=["email", "ticket_name", "total_amount"],
+                                        date_from=since).getvalue())
+
+
+if __name__ == "__main__":
+    main()
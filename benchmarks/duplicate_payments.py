@@ -0,0 +1,111 @@
+"""Duplicate payments: the same successful_payment update handled by several threads at once.
+
+    python -m benchmarks.duplicate_payments [--payments 200] [--duplicates 4] [--legacy]
+
+Every payment is dispatched by --duplicates threads released together. Afterwards each payment must
+have exactly one purchase, one confirmation to the buyer and count once in the purchase statistics.
+--legacy swaps in the old exists() check followed by a separate write to show the race it had.
+Exits with status 1 when any payment was processed more than once.
+"""
+import argparse
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+
+from benchmarks.handlers import PAID_TICKET, SEEDED_USERS_START, database, load_bot, message_payload, reset
+from benchmarks.recording_bot import recording_bot
+
+SEEDED_USERS = 1000
+
+
+def legacy_create_new(cls, _id: str):
+    from telegram import TelegramError
+    if cls.exists(_id):
+        raise TelegramError(f"Попытка создать покупку с существующем id {_id}")
+    # The window between the check and the write, a Firebase round trip in production
+    time.sleep(0.001)
+    data = {'id': _id, 'created': datetime.now().timestamp()}
+    cls.ref().child(_id).update(data)
+    return cls.get(_id, data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payments", type=int, default=200)
+    parser.add_argument("--duplicates", type=int, default=4)
+    parser.add_argument("--legacy", action="store_true")
+    args = parser.parse_args()
+
+    bot_module = load_bot()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    from telegram import Update
+    from telegram.ext import ContextTypes, Dispatcher
+    from handlers.bot_context import BotContext
+    from models.stats import Stats
+    from models.ticket_purchases import TicketPurchase
+    from utils.outbound_queue import outbound
+    from utils.update_queue import UpdateQueue
+
+    if args.legacy:
+        TicketPurchase.create_new = classmethod(legacy_create_new)
+
+    bot = recording_bot()
+    dispatcher = Dispatcher(bot, UpdateQueue(100), persistence=bot_module.store,
+                            context_types=ContextTypes(context=BotContext))
+    bot_module.add_handlers(dispatcher)
+    outbound.start(bot)
+    bot_module.ticket_delivery.start(bot)
+    reset(bot_module, SEEDED_USERS)
+    purchases_before = Stats.get()["purchases"][PAID_TICKET]["count"]
+
+    started = time.perf_counter()
+    charges = []
+    for index in range(args.payments):
+        # Seeded users 1, 6, 11... are approved and have no ticket yet
+        user_id = SEEDED_USERS_START + (1 + 5 * index) % SEEDED_USERS
+        charge = f"provider-duplicate-{index}"
+        charges.append(charge)
+        payload = message_payload(user_id, successful_payment={
+            "currency": "RUB", "total_amount": 350000, "invoice_payload": PAID_TICKET,
+            "telegram_payment_charge_id": f"tg-duplicate-{index}", "provider_payment_charge_id": charge,
+            "order_info": {"name": f"Гость {user_id}"},
+        })
+
+        barrier = threading.Barrier(args.duplicates)
+
+        def dispatch():
+            update = Update.de_json(dict(payload, update_id=index + 1), bot)
+            barrier.wait()
+            dispatcher.process_update(update)
+
+        threads = [threading.Thread(target=dispatch) for _ in range(args.duplicates)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    bot_module.ticket_delivery.stop()
+    outbound.stop()
+
+    confirmations = sum(1 for method, _, text in bot.request.sent
+                        if method == "sendMessage" and text == bot_module.state_texts[bot_module.READY_DASHBOARD])
+    stored = database.data.get("ticket_purchases", {})
+    counted = Stats.get()["purchases"][PAID_TICKET]["count"] - purchases_before
+    missing = [charge for charge in charges if charge not in stored]
+
+    print(f"{args.payments} payments x {args.duplicates} parallel updates in {elapsed:.2f}s"
+          f"{' (legacy create)' if args.legacy else ''}:")
+    print(f"  purchases stored {args.payments - len(missing)}, confirmations sent {confirmations}, "
+          f"counted in statistics {counted}")
+
+    duplicated = confirmations != args.payments or counted != args.payments or missing
+    print("  FAILED: some payments were processed more than once or lost" if duplicated else "  OK")
+    sys.exit(1 if duplicated else 0)
+
+
+if __name__ == "__main__":
+    main()
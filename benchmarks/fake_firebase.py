@@ -0,0 +1,173 @@
+"""In-memory stand-in for the subset of firebase_admin.db.Reference the bot uses."""
+import collections
+import copy
+import uuid
+from threading import RLock
+
+from persistence.sqlite_storage import resolve_server_values
+
+
+class FakeDatabase:
+
+    def __init__(self, data: dict = None):
+        self.data = data if data is not None else {}
+        self.calls = collections.Counter()
+        # Child nodes of collections returned by get() and queries, full scans show up here
+        self.rows = 0
+        self.lock = RLock()
+
+    def reference(self, path: str = "/") -> "FakeReference":
+        return FakeReference(self, [part for part in path.split("/") if part])
+
+    def count(self, operation: str):
+        self.calls[operation] += 1
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.rows = 0
+
+
+class FakeReference:
+
+    def __init__(self, database: FakeDatabase, parts: list):
+        self._db = database
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return "/" + "/".join(self._parts)
+
+    def child(self, path: str) -> "FakeReference":
+        return FakeReference(self._db, self._parts + [part for part in str(path).split("/") if part])
+
+    def get(self):
+        self._db.count("get")
+        with self._db.lock:
+            node = self._node()
+            if len(self._parts) <= 1 and isinstance(node, dict):
+                self._db.rows += len(node)
+            return copy.deepcopy(node)
+
+    def set(self, value):
+        self._db.count("set")
+        with self._db.lock:
+            self._write(self._parts, copy.deepcopy(value))
+
+    def update(self, value: dict):
+        self._db.count("update")
+        with self._db.lock:
+            for path, item in value.items():
+                self._write(self._parts + [part for part in path.split("/") if part], copy.deepcopy(item))
+
+    def delete(self):
+        self._db.count("delete")
+        with self._db.lock:
+            self._write(self._parts, None)
+
+    def push(self, value=None):
+        ref = self.child(uuid.uuid4().hex)
+        if value is not None:
+            ref.set(value)
+        return ref
+
+    def transaction(self, transaction_update):
+        self._db.count("transaction")
+        with self._db.lock:
+            value = transaction_update(copy.deepcopy(self._node()))
+            self._write(self._parts, copy.deepcopy(value))
+            return value
+
+    def listen(self, callback):
+        return None
+
+    def order_by_child(self, path: str) -> "FakeQuery":
+        return FakeQuery(self, lambda key, value: value.get(path) if isinstance(value, dict) else None)
+
+    def order_by_key(self) -> "FakeQuery":
+        return FakeQuery(self, lambda key, value: key)
+
+    def order_by_value(self) -> "FakeQuery":
+        return FakeQuery(self, lambda key, value: value)
+
+    def _node(self):
+        node = self._db.data
+        for part in self._parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _write(self, parts: list, value):
+        if not parts:
+            self._db.data = value if value is not None else {}
+            return
+
+        node = self._db.data
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        value = resolve_server_values(value, node.get(parts[-1]))
+        if value is None or value == {}:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+
+class FakeQuery:
+
+    def __init__(self, ref: FakeReference, order_key):
+        self._ref = ref
+        self._order_key = order_key
+        self._start = None
+        self._start_key = None
+        self._end = None
+        self._first = None
+        self._last = None
+
+    def start_at(self, value, key: str = None):
+        self._start = value
+        self._start_key = key
+        return self
+
+    def end_at(self, value):
+        self._end = value
+        return self
+
+    def equal_to(self, value):
+        self._start = self._end = value
+        return self
+
+    def limit_to_first(self, limit: int):
+        self._first = limit
+        return self
+
+    def limit_to_last(self, limit: int):
+        self._last = limit
+        return self
+
+    def get(self):
+        self._ref._db.count("query")
+        with self._ref._db.lock:
+            node = self._ref._node() or {}
+            items = [(self._order_key(key, value), key, value) for key, value in node.items()]
+
+        items = [item for item in items if item[0] is not None or (self._start is None and self._end is None)]
+        if self._start is not None:
+            items = [item for item in items if item[0] is not None and item[0] >= self._start]
+        if self._start_key is not None:
+            items = [item for item in items if item[0] != self._start or item[1] >= self._start_key]
+        if self._end is not None:
+            items = [item for item in items if item[0] is not None and item[0] <= self._end]
+        items.sort(key=lambda item: (item[0] is not None, item[0] if item[0] is not None else 0, item[1]))
+        if self._first is not None:
+            items = items[:self._first]
+        if self._last is not None:
+            items = items[-self._last:]
+        self._ref._db.rows += len(items)
+        return collections.OrderedDict((key, copy.deepcopy(value)) for _, key, value in items)
@@ -0,0 +1,142 @@
+"""Gate scanners: several admins checking in the same tickets at the same time.
+
+    python -m benchmarks.gate_scanners [--scanners 8] [--tickets 200] [--legacy | --offline]
+
+Every scanner is an admin in the check-in state who sends the codes of all --tickets in its own random
+order, so each ticket is scanned by every gate and the scans of one ticket overlap. Afterwards every
+ticket must have been admitted exactly once: one success reply, stored as activated and counted once in
+the statistics. --legacy swaps in the old read of the purchase followed by a separate save to show the
+race it had, --offline checks in against the local index and syncs the journal at the end.
+Exits with status 1 when any ticket was admitted more than once.
+"""
+import argparse
+import collections
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from benchmarks.handlers import ADMIN_ID, database, load_bot, message_payload, reset
+from benchmarks.recording_bot import recording_bot
+
+SEEDED_USERS = 1000
+SUCCESS = "<b>ФУК ЕЕЕЕЕ! Успешно зареган!</b>"
+
+
+def legacy_check_code(update, code: str):
+    from models.ticket_purchases import TicketPurchase
+    try:
+        ticket_purchase = TicketPurchase.get(code)
+        if ticket_purchase.activated:
+            update.message.reply_text(ticket_purchase.pretty_detailed_html())
+        else:
+            # The window between the read and the write, a Firebase round trip in production
+            time.sleep(0.001)
+            ticket_purchase.activated = datetime.now().timestamp()
+            ticket_purchase.save()
+            update.message.reply_html(f"{SUCCESS}\n\n" + ticket_purchase.pretty_detailed_html())
+    except:
+        update.message.reply_text("Хмм... какая-то хуита. Нет такого билета.")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scanners", type=int, default=8)
+    parser.add_argument("--tickets", type=int, default=200)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--legacy", action="store_true")
+    mode.add_argument("--offline", action="store_true")
+    args = parser.parse_args()
+
+    os.environ["CHECKIN_JOURNAL_PATH"] = os.path.join(tempfile.mkdtemp(), "checkin_journal.jsonl")
+    bot_module = load_bot()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    from telegram import Update
+    from telegram.ext import ContextTypes, Dispatcher
+    from handlers.bot_context import BotContext
+    from models.stats import Stats
+    from models.ticket_purchases import TicketPurchase
+    from models.users import User
+    from settings import Settings
+    from utils.update_queue import UpdateQueue
+
+    if args.legacy:
+        bot_module.admin_function_check_code = legacy_check_code
+
+    bot = recording_bot()
+    dispatcher = Dispatcher(bot, UpdateQueue(100), persistence=bot_module.store,
+                            context_types=ContextTypes(context=BotContext))
+    bot_module.add_handlers(dispatcher)
+    reset(bot_module, SEEDED_USERS)
+
+    scanners = [ADMIN_ID + 1 + index for index in range(args.scanners)]
+    for scanner in scanners:
+        database.data["users"][str(scanner)] = {"id": scanner, "created": 0, "status": "approved",
+                                                "real_name": f"Сканер {scanner}", "admin": True}
+    database.data["settings"] = {"offline_checkin": args.offline}
+    User._roles.clear()
+    Settings.invalidate()
+
+    tickets = sorted(database.data["ticket_purchases"])[:args.tickets]
+    activated_before = Stats.get()["activated"]
+    update_ids = iter(range(1, 10 ** 9))
+    lock = threading.Lock()
+
+    def process(user_id: int, text: str):
+        with lock:
+            update_id = next(update_ids)
+        dispatcher.process_update(Update.de_json(dict(message_payload(user_id, text), update_id=update_id), bot))
+
+    for scanner in scanners:
+        process(scanner, "Admin")
+        process(scanner, bot_module.BUTTON_ADMIN_CHECKIN)
+    bot.request.reset()
+    database.reset_counters()
+
+    barrier = threading.Barrier(len(scanners))
+
+    def scan(scanner: int):
+        codes = list(tickets)
+        random.Random(scanner).shuffle(codes)
+        barrier.wait()
+        for code in codes:
+            process(scanner, code)
+
+    threads = [threading.Thread(target=scan, args=(scanner,)) for scanner in scanners]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    if args.offline:
+        bot_module.checkin.start(TicketPurchase.store_activations)
+        bot_module.checkin.stop()
+
+    admitted = collections.Counter(text.split("Владелец билета: ")[1].split("\n")[0]
+                                   for method, _, text in bot.request.sent if text and text.startswith(SUCCESS))
+    purchases = database.data["ticket_purchases"]
+    stored = sum(1 for code in tickets if purchases[code].get("activated"))
+    counted = Stats.get()["activated"] - activated_before
+    scans = len(scanners) * len(tickets)
+
+    print(f"{len(scanners)} scanners x {len(tickets)} tickets, {scans} scans in {elapsed:.2f}s, "
+          f"{scans / elapsed:.0f} scans/s, {database.total_calls() / scans:.1f} db calls per scan"
+          f"{' (legacy check)' if args.legacy else ' (offline index)' if args.offline else ''}:")
+    print(f"  admitted {len(admitted)} tickets, {sum(admitted.values())} success replies, "
+          f"stored as activated {stored}, counted in statistics {counted}")
+
+    doubled = sum(admitted.values()) - len(admitted)
+    failed = doubled or len(admitted) != len(tickets) or stored != len(tickets) or counted != len(tickets)
+    print(f"  FAILED: {doubled} double activations" if failed else "  OK: zero double activations")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Handlers end to end: the real dispatcher and handlers of main.py on the fake database and a recording bot.
+
+    python -m benchmarks.handlers [--sizes 100 10000 100000] [--flows 50] [--admin-rounds 10]
+
+Each flow registers a new user and buys a ticket (/start, name, VK, pre-checkout, payment, my ticket
+twice: the first time the image may still have to be uploaded, then it is sent by its Telegram file_id).
+Each admin round opens the dashboard, statistics, the user list and its next page, one user, gifts a
+ticket, checks a code in and exports the purchases CSV. Per update type it prints latency percentiles,
+database calls and rows read per update; rows growing with the number of users mean a full scan.
+
+The fake database sorts and copies the whole node for every query, so latency of queries grows with
+the node size much faster than on Firebase. Calls and rows per update are the numbers to compare.
+"""
+import argparse
+import collections
+import logging
+import os
+import time
+from datetime import datetime
+
+from benchmarks.fake_firebase import FakeDatabase
+from benchmarks.recording_bot import recording_bot
+from benchmarks.timing import summary, timed
+
+ADMIN_ID = 1
+FLOW_USERS_START = 10 ** 7
+SEEDED_USERS_START = 10 ** 5
+
+PAID_TICKET = "Билет ДММ2022"
+FREE_TICKET = "Приглашение ДММ2022"
+
+database = FakeDatabase()
+
+
+def load_bot():
+    os.environ.setdefault("BOT_PAYMENT_PROVIDER_TOKEN", "benchmark")
+    from persistence import firebase_persistence
+    firebase_persistence.configure(database.reference)
+
+    import main
+    return main
+
+
+def seed(users: int) -> dict:
+    created = datetime(2022, 4, 1).timestamp()
+    data = collections.defaultdict(dict)
+    data["tickets"] = {
+        PAID_TICKET: {"description": "Вход на все дни", "price": 3500, "order": 1, "type": "paid", "increase_step": 0},
+        FREE_TICKET: {"description": "Подарок от оргов", "price": 0, "order": 2, "type": "free", "increase_step": 0},
+    }
+    data["users"][str(ADMIN_ID)] = {"id": ADMIN_ID, "created": created, "status": "approved", "real_name": "Админ",
+                                    "first_name": "Админ", "admin": True, "god": True}
+
+    statuses = ["just_open_bot", "approved", "approved", "ready", "ready"]
+    for index in range(users):
+        _id = SEEDED_USERS_START + index
+        status = statuses[index % len(statuses)]
+        user = {"id": _id, "created": created + index, "status": status, "first_name": f"Гость {index}",
+                "username": f"guest{index}", "real_name": f"Гость {index}", "vk": f"https://vk.com/guest{index}"}
+        if status == "ready":
+            purchase_id = f"purchase-{_id}"
+            user["purchase_id"] = purchase_id
+            data["ticket_purchases"][purchase_id] = {
+                "id": purchase_id, "created": created + index, "currency": "RUB", "total_amount": 350000,
+                "ticket_name": PAID_TICKET, "ticket_base_price": 3500, "ticket_description": "Вход на все дни",
+                "user": _id, "user_name": user["real_name"], "user_username": f"@guest{index}",
+                "provider_payment_charge_id": purchase_id, "telegram_payment_charge_id": purchase_id,
+            }
+            data["conversations"].setdefault("user_states_conversation", {})[f"({_id},)"] = 5
+        data["users"][str(_id)] = user
+    return dict(data)
+
+
+def message_payload(user_id: int, text: str = None, **fields) -> dict:
+    message = {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id, "is_bot": False, "first_name": f"Гость {user_id}",
+                        "username": f"guest{user_id}"}}
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    message.update(fields)
+    return {"message": message}
+
+
+class Driver:
+    """Builds updates the way Telegram sends them and feeds them to the dispatcher."""
+
+    def __init__(self, main, dispatcher):
+        self.main = main
+        self.dispatcher = dispatcher
+        self.bot = dispatcher.bot
+        self.latency = collections.defaultdict(list)
+        self.calls = collections.defaultdict(list)
+        self.rows = collections.defaultdict(list)
+        self.bot_calls = collections.defaultdict(list)
+        self._update_ids = iter(range(1, 10 ** 9))
+
+    def process(self, step: str, payload: dict):
+        from telegram import Update
+        update = Update.de_json(dict(payload, update_id=next(self._update_ids)), self.bot)
+
+        calls, rows, bot_calls = database.total_calls(), database.rows, self.bot.request.total_calls()
+        with timed(self.latency[step]):
+            self.dispatcher.process_update(update)
+        self.calls[step].append(database.total_calls() - calls)
+        self.rows[step].append(database.rows - rows)
+        self.bot_calls[step].append(self.bot.request.total_calls() - bot_calls)
+
+    def message(self, step: str, user_id: int, text: str = None, **fields):
+        self.process(step, message_payload(user_id, text, **fields))
+
+    def callback(self, step: str, user_id: int, data: str):
+        self.process(step, {"callback_query": {
+            "id": str(user_id), "chat_instance": "benchmark", "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Админ"},
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                        "text": "..."},
+        }})
+
+    def user_flow(self, user_id: int):
+        self.message("start", user_id, "/start")
+        self.message("set_name", user_id, f"Гость {user_id}")
+        self.message("set_vk", user_id, f"https://vk.com/guest{user_id}")
+        self.process("precheckout", {"pre_checkout_query": {
+            "id": str(user_id), "currency": "RUB", "total_amount": 350000, "invoice_payload": PAID_TICKET,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Гость {user_id}"},
+        }})
+        self.message("payment", user_id, successful_payment={
+            "currency": "RUB", "total_amount": 350000, "invoice_payload": PAID_TICKET,
+            "telegram_payment_charge_id": f"tg-{user_id}", "provider_payment_charge_id": f"provider-{user_id}",
+            "order_info": {"name": f"Гость {user_id}", "email": f"guest{user_id}@example.com",
+                           "phone_number": "79990000000"},
+        })
+        self.message("my_ticket", user_id, self.main.BUTTON_MY_TICKET)
+        self.message("my_ticket_again", user_id, self.main.BUTTON_MY_TICKET)
+
+    def admin_round(self, users: int, index: int):
+        main = self.main
+        # Seeded users cycle through statuses, every fifth one from 1 is approved without a ticket
+        approved = SEEDED_USERS_START + (1 + 5 * index) % max(users, 1)
+        ready = SEEDED_USERS_START + (3 + 5 * index) % max(users, 1)
+        cursor = f"{datetime(2022, 4, 1).timestamp() + users // 2}:{SEEDED_USERS_START + users // 2}"
+
+        self.message("admin_dashboard", ADMIN_ID, "Admin")
+        self.message("admin_stats", ADMIN_ID, main.BUTTON_ADMIN_STATS)
+        self.message("admin_list", ADMIN_ID, main.BUTTON_ADMIN_ALL)
+        self.callback("admin_list_page", ADMIN_ID, f"{main.CALLBACK_BUTTON_USERS_PAGE}:{cursor}")
+        self.message("admin_one_user", ADMIN_ID, f"/{approved}")
+        self.callback("admin_gift", ADMIN_ID, f"{main.CALLBACK_BUTTON_GIFT_TICKET}:{approved}")
+        self.message("admin_checkin", ADMIN_ID, main.BUTTON_ADMIN_CHECKIN)
+        self.message("admin_check_code", ADMIN_ID, f"purchase-{ready}")
+        self.message("admin_back", ADMIN_ID, main.BUTTON_BACK)
+        self.message("admin_csv", ADMIN_ID, main.BUTTON_ADMIN_CSV)
+        self.message("admin_back", ADMIN_ID, main.BUTTON_BACK)
+
+    def report(self):
+        for step in self.latency:
+            calls, rows, bot_calls = self.calls[step], self.rows[step], self.bot_calls[step]
+            print(f"  {step:<16} {summary(self.latency[step])}")
+            print(f"  {'':<16} db calls/update {sum(calls) / len(calls):.1f}, rows/update {sum(rows) / len(rows):.0f}, "
+                  f"bot calls/update {sum(bot_calls) / len(bot_calls):.1f}")
+
+
+def run_synchronously(handlers: list):
+    # The cost of run_async handlers belongs to the update that triggered them
+    from telegram.ext import ConversationHandler
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            run_synchronously(handler.entry_points + handler.fallbacks +
+                              [nested for state in handler.states.values() for nested in state])
+        else:
+            handler.run_async = False
+
+
+def reset(main, users: int):
+    from models.base_products import BaseProduct
+    from models.stats import Stats
+    from models.users import User
+    from settings import Settings
+
+    database.data = seed(users)
+    User._roles.clear()
+    BaseProduct._catalogs.clear()
+    Settings.invalidate()
+    main.store._conversations.clear()
+    for handler in (main.conv_handler, main.conv_admin_handler):
+        handler.conversations = main.store.get_conversations(handler.name)
+    Stats.rebuild()
+    database.reset_counters()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--flows", type=int, default=50)
+    parser.add_argument("--admin-rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    bot_module = load_bot()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from telegram.ext import ContextTypes, Dispatcher
+    from handlers.bot_context import BotContext
+    from utils.outbound_queue import outbound
+    from utils.update_queue import UpdateQueue
+
+    bot = recording_bot()
+    dispatcher = Dispatcher(bot, UpdateQueue(100), persistence=bot_module.store,
+                            context_types=ContextTypes(context=BotContext))
+    bot_module.add_handlers(dispatcher)
+    run_synchronously(dispatcher.handlers[0])
+    outbound.start(bot)
+    bot_module.ticket_delivery.start(bot)
+
+    try:
+        for size in args.sizes:
+            reset(bot_module, size)
+            driver = Driver(bot_module, dispatcher)
+            for index in range(args.flows):
+                driver.user_flow(FLOW_USERS_START + index)
+            for index in range(args.admin_rounds):
+                driver.admin_round(size, index)
+
+            print(f"{size} users:")
+            driver.report()
+    finally:
+        bot_module.ticket_delivery.stop()
+        outbound.stop()
+
+
+if __name__ == "__main__":
+    main()
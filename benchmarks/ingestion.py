@@ -0,0 +1,177 @@
+"""Update ingestion: long polling against webhook, through a local stand-in for the Telegram Bot API.
+
+    python -m benchmarks.ingestion [--updates 2000] [--workers 4 16] [--queue-size 200] [--connections 40]
+
+The stand-in serves getUpdates from a prepared backlog and answers every other method over real HTTP,
+so replies cost a local round trip. In webhook mode a client posts the same backlog to the bot's webhook
+server with as many parallel connections as Telegram would open. The mix is seeded users asking for their
+status, the info text and their state, and one in twenty opening their ticket, which renders an image
+in a run_async worker. A run ends when every handler callback has returned. Rendering holds the GIL,
+so more workers only help while handlers wait on the database or the Bot API.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.handlers import SEEDED_USERS_START, load_bot, message_payload, reset
+from benchmarks.recording_bot import TOKEN, api_result
+
+SEEDED_USERS = 1000
+# Long polls are held this long at most, so stopping the updater does not wait for the default timeout
+POLL_WAIT = 0.5
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeBotApiHandler)
+        self.backlog = []
+        self.calls = 0
+        self.lock = threading.Condition()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def load(self, updates: list):
+        with self.lock:
+            self.backlog = list(updates)
+            self.lock.notify_all()
+
+    def get_updates(self, offset: int, limit: int) -> list:
+        with self.lock:
+            self.backlog = [update for update in self.backlog if update["update_id"] >= offset]
+            if not self.backlog:
+                self.lock.wait(POLL_WAIT)
+            return self.backlog[:limit]
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        data = json.loads(body) if self.headers.get("Content-Type", "").startswith("application/json") else {}
+
+        api = self.server
+        with api.lock:
+            api.calls += 1
+        if method == "getUpdates":
+            result = api.get_updates(int(data.get("offset") or 0), int(data.get("limit") or 100))
+        else:
+            result = api_result(method, data, next(api._message_ids))
+
+        response = json.dumps({"ok": True, "result": result}).encode("UTF8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def backlog(main, count: int) -> list:
+    texts = [main.BUTTON_STATUS, main.BUTTON_INFO, "Привет"]
+    updates = []
+    for index in range(count):
+        user_id = SEEDED_USERS_START + index % SEEDED_USERS
+        if index % 20 == 19:
+            # Every fifth seeded user has a ticket, see benchmarks.handlers.seed
+            user_id = SEEDED_USERS_START + 3 + 5 * (index % (SEEDED_USERS // 5))
+            text = main.BUTTON_MY_TICKET
+        else:
+            text = texts[index % len(texts)]
+        updates.append(dict(message_payload(user_id, text), update_id=index + 1))
+    return updates
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def handled(metrics) -> int:
+    return sum(histogram.count for name, histogram in metrics.handlers.items() if name != "release_identity_map")
+
+
+def run(main, api: FakeBotApi, mode: str, updates: list, workers: int, queue_size: int, connections: int):
+    from settings import Settings
+    from utils.instrumentation import metrics
+    from utils.update_queue import UpdateQueue
+
+    reset(main, SEEDED_USERS)
+    update_queue = UpdateQueue(queue_size)
+    updater = main.create_updater(update_queue)
+    metrics.instrument(updater.dispatcher)
+    already_handled = handled(metrics)
+
+    started = time.perf_counter()
+    if mode == Settings.MODE_WEBHOOK:
+        port = free_port()
+        updater.start_webhook(listen="127.0.0.1", port=port, url_path="telegram",
+                              webhook_url=f"http://127.0.0.1:{port}/telegram")
+        time.sleep(0.2)
+        started = time.perf_counter()
+
+        def post(update: dict):
+            request = urllib.request.Request(f"http://127.0.0.1:{port}/telegram", data=json.dumps(update).encode(),
+                                             headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(request).read()
+
+        with ThreadPoolExecutor(connections) as pool:
+            list(pool.map(post, updates))
+    else:
+        api.load(updates)
+        updater.start_polling(poll_interval=0, timeout=1)
+
+    while handled(metrics) - already_handled < len(updates):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    updater.stop()
+
+    print(f"  {mode:<8} workers={workers:<3} {len(updates) / elapsed:7.0f} updates/s, {elapsed:.2f}s, "
+          f"queue max {update_queue.max_depth}/{queue_size}, producer blocked {update_queue.blocked} times "
+          f"for {update_queue.blocked_seconds:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--queue-size", type=int, default=200)
+    parser.add_argument("--connections", type=int, default=40)
+    args = parser.parse_args()
+
+    api = FakeBotApi()
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["BOT_API_URL"] = api.url
+    bot_module = load_bot()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from settings import Settings
+    updates = backlog(bot_module, args.updates)
+    for workers in args.workers:
+        os.environ["BOT_WORKERS"] = str(workers)
+        for mode in (Settings.MODE_POLLING, Settings.MODE_WEBHOOK):
+            run(bot_module, api, mode, updates, workers, args.queue_size, args.connections)
+
+    api.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Per-record memory and attribute access: descriptor models against the old property style.
+
+    python -m benchmarks.models [--count 100000]
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime
+
+from models.fields import Field, Model, TimestampField
+from utils import helper
+
+
+class LegacyUser:
+    # The property-per-field style the models used before models.fields
+
+    def __init__(self):
+        self._id = None
+        self._data = {}
+
+    @property
+    def status(self):
+        return helper.safe_list_get(self._data, "status")
+
+    @status.setter
+    def status(self, status: str):
+        self._data["status"] = status
+
+    @property
+    def real_name(self):
+        return helper.safe_list_get(self._data, "real_name")
+
+    @property
+    def vk(self):
+        return helper.safe_list_get(self._data, "vk")
+
+    @property
+    def admin(self):
+        return helper.safe_list_get(self._data, "admin", False)
+
+    @property
+    def created(self):
+        timestamp = helper.safe_list_get(self._data, "created")
+        if timestamp:
+            return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SlottedUser(Model):
+    __slots__ = ()
+
+    status = Field("")
+    real_name = Field("")
+    vk = Field("")
+    admin = Field(False)
+    created = TimestampField()
+
+    @classmethod
+    def ref(cls):
+        # Built from data in memory only, never stored
+        return None
+
+
+def records(count: int):
+    started = datetime(2022, 5, 1).timestamp()
+    return [{'id': index, 'created': started + index, 'status': 'approved', 'real_name': f'Гость {index}',
+             'vk': f'https://vk.com/guest{index}', 'first_name': 'Гость', 'username': f'guest{index}'}
+            for index in range(count)]
+
+
+def build(cls, data):
+    objects = []
+    for index, item in enumerate(data):
+        instance = cls()
+        instance._id = index
+        if isinstance(instance, Model):
+            instance.set_stored(item)
+        else:
+            instance._data = item
+        objects.append(instance)
+    return objects
+
+
+def measure(cls, data):
+    tracemalloc.start()
+    started = time.perf_counter()
+    objects = build(cls, data)
+    build_time = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for instance in objects:
+        instance.status, instance.real_name, instance.vk, instance.admin
+    access_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(3):
+        for instance in objects:
+            instance.created
+    created_time = time.perf_counter() - started
+
+    count = len(objects)
+    print(f"{cls.__name__}: {size / count:.0f} B/record, build {build_time * 1e9 / count:.0f} ns/record, "
+          f"4 fields {access_time * 1e9 / count:.0f} ns/record, created x3 {created_time * 1e9 / count:.0f} ns/record")
+
+    started = time.perf_counter()
+    for instance in objects:
+        instance.status = 'ready'
+    print(f"  status write {(time.perf_counter() - started) * 1e9 / count:.0f} ns/record")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    measure(LegacyUser, records(args.count))
+    measure(SlottedUser, records(args.count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Local QR decoding over a folder of ticket photos.
+
+    python -m benchmarks.qr_decode path/to/photos [--repeat 3]
+"""
+import argparse
+import os
+
+from benchmarks.timing import summary, timed
+from utils.qr_decoder import QrDecoder
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    decoder = QrDecoder()
+    if not decoder.available:
+        raise SystemExit("opencv is not installed, local decoding is unavailable")
+
+    photos = []
+    for name in sorted(os.listdir(args.folder)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(args.folder, name), "rb") as f:
+                photos.append((name, f.read()))
+
+    if not photos:
+        raise SystemExit(f"no photos in {args.folder}")
+
+    samples = []
+    failed = set()
+    for _ in range(args.repeat):
+        for name, image_bytes in photos:
+            with timed(samples):
+                code = decoder.decode(image_bytes)
+            if not code:
+                failed.add(name)
+
+    print(f"photos: {len(photos)}, decoded: {len(photos) - len(failed)}")
+    print(f"decode: {summary(samples)}")
+    for name in sorted(failed):
+        print(f"  not decoded: {name}")
+
+
+if __name__ == "__main__":
+    main()
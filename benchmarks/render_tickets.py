@@ -0,0 +1,76 @@
+"""Ticket render throughput: the in-memory TicketRenderer against the old temp-file path.
+
+    python -m benchmarks.render_tickets [--count 200] [--threads 4]
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pyqrcode
+from PIL import Image, ImageDraw, ImageFont
+
+from benchmarks.timing import summary, timed
+from utils.ticket_renderer import TicketRenderer
+
+LINES = ['Имя: Вася Пупкин', 'Тип: Билет ДММ2022', 'Стоимость: 3500.0 рублей', 'Дата: 2022-06-01 12:00:00 (UTC)']
+
+
+def render_legacy(code: str, workdir: str) -> bytes:
+    # Mirrors the original TicketPurchase.create_image: temp PNG on disk, fonts loaded per call
+    tmp_path = os.path.join(workdir, "tmp_code.png")
+    pyqrcode.create(code).png(tmp_path, scale=20, module_color=[0, 0, 0, 128], background=(255, 255, 255))
+    qr = Image.open(tmp_path)
+    width = qr.width + 60
+    qr_img = Image.new('RGB', (width, width), color=(44, 44, 212))
+    qr_img.paste(qr, (30, 30))
+    text_img = Image.new('RGB', (width, 420), color=(44, 44, 212))
+    d = ImageDraw.Draw(text_img)
+    d.text((50, 50), "DMM 2022", fill=(255, 255, 255),
+           font=ImageFont.FreeTypeFont('fonts/HelveticaBlack.ttf', 60, encoding="utf-8"))
+    slave_font = ImageFont.FreeTypeFont('fonts/arial.ttf', 40, encoding="utf-8")
+    for index, line in enumerate(LINES):
+        d.text((60, 130 + index * 50), line, fill=(255, 255, 255), font=slave_font)
+    ticket = Image.new('RGB', (width, width + 420))
+    ticket.paste(text_img, (0, 0))
+    ticket.paste(qr_img, (0, 420))
+    out_path = os.path.join(workdir, f"{code}.png")
+    ticket.save(out_path)
+    with open(out_path, "rb") as f:
+        return f.read()
+
+
+def run(name, render, codes, threads):
+    samples = []
+
+    def one(code):
+        with timed(samples):
+            render(code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, codes))
+    elapsed = time.perf_counter() - started
+    print(f"{name}: {len(codes) / elapsed:.1f} tickets/s, {summary(samples)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    codes = [str(uuid.uuid4()) for _ in range(args.count)]
+
+    renderer = TicketRenderer()
+    run("renderer", lambda code: renderer.render_png(code, LINES).getvalue(), codes, args.threads)
+
+    # The legacy path shares tmp_code.png, so it is only measured single-threaded
+    with tempfile.TemporaryDirectory() as workdir:
+        run("legacy", lambda code: render_legacy(code, workdir), codes, 1)
+
+
+if __name__ == "__main__":
+    main()
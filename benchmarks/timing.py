@@ -0,0 +1,34 @@
+import time
+from contextlib import contextmanager
+from typing import List
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summary(samples: List[float]) -> str:
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    if not samples:
+        return "no samples"
+    return "n={} mean={:.2f}ms p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms max={:.2f}ms".format(
+        len(samples),
+        sum(samples) / len(samples) * 1000,
+        percentile(samples, 50) * 1000,
+        percentile(samples, 95) * 1000,
+        percentile(samples, 99) * 1000,
+        max(samples) * 1000,
+    )
+
+
+@contextmanager
+def timed(samples: List[float]):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        samples.append(time.perf_counter() - started)
@@ -0,0 +1,20 @@
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher
+
+from utils.identity_map import IdentityMap
+
+
+class BotContext(CallbackContext):
+    """Callback context carrying the identity map of the update being handled."""
+
+    @classmethod
+    def from_update(cls, update: object, dispatcher: Dispatcher) -> "BotContext":
+        self = super().from_update(update, dispatcher)
+        # Handlers run in the dispatcher thread, models find the map through it
+        self.identity_map = IdentityMap.bind(update)
+        return self
+
+
+def release_identity_map(update: Update, context: BotContext) -> None:
+    """Registered in the last handler group, closes the identity map once the update is handled."""
+    IdentityMap.release()
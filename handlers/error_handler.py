@@ -10,6 +10,7 @@ from telegram.ext import (
 )
 
 from models.users import User
+from utils.outbound_queue import outbound, PRIORITY_ADMIN
 
 logger = logging.getLogger(__name__)
 
@@ -44,4 +45,4 @@ def error_handler(update: object, context: CallbackContext) -> None:
     )
 
     for admin in User.gods():
-        context.bot.send_message(chat_id=admin.id, text=message, parse_mode=ParseMode.HTML)
+        outbound.send(admin.id, message, priority=PRIORITY_ADMIN, parse_mode=ParseMode.HTML)
@@ -5,21 +5,34 @@ import logging
 import random
 import re
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import requests
 from emoji import emojize
-from typing import Optional
+from typing import Optional, Tuple
 from telegram import ReplyKeyboardMarkup, Update, ParseMode, TelegramError, ReplyKeyboardRemove, LabeledPrice
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.request import Request
+from telegram.error import BadRequest
 
+from models.broadcasts import Broadcast
+from models.stats import Stats
 from models.ticket_purchases import TicketPurchase
 from settings import Settings
 from models.tickets import Ticket
 from models.users import User
+from handlers.bot_context import BotContext, release_identity_map
 from handlers.error_handler import error_handler
 from persistence.firebase_persistence import FirebasePersistence
+from persistence.unit_of_work import UnitOfWork
 from utils import helper
+from utils.identity_map import IdentityMap
+from utils.instrumentation import metrics
+from utils.offline_checkin import Conflict, OfflineCheckin
+from utils.outbound_queue import outbound, PRIORITY_ADMIN, PRIORITY_PAYMENT
+from utils.qr_decoder import decoder
+from utils.update_queue import UpdateQueue
+from utils.ticket_delivery import TicketDelivery
 from telegram.ext import (
     Updater,
     CommandHandler,
@@ -28,6 +41,10 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
     CallbackContext, PreCheckoutQueryHandler,
+    ContextTypes,
+    Dispatcher,
+    JobQueue,
+    TypeHandler,
 )
 
 # Enable logging
@@ -35,12 +52,23 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
 QRCODE_SERVICE_API_URL = 'http://api.qrserver.com/v1/read-qr-code/'
+QRCODE_REMOTE_FALLBACK = True
+QRCODE_REMOTE_TIMEOUT = 10
 BULK_SEND_SLEEP_STEP = 25
+ADMIN_USERS_PAGE_SIZE = 10
+# Handlers of this group run after all others, the request-scoped identity map is closed there
+IDENTITY_MAP_GROUP = 100
+TICKET_DELIVERY_WORKERS = 2
+TICKET_DELIVERY_QUEUE_SIZE = 200
+METRICS_DUMP_INTERVAL = 60
+WEBHOOK_MAX_CONNECTIONS = 40
 
 CONVERSATION_NAME = "user_states_conversation"
 CONVERSATION_ADMIN_NAME = "admin_states_conversation"
 
 store = FirebasePersistence()
+ticket_delivery = TicketDelivery(workers=TICKET_DELIVERY_WORKERS, max_queue=TICKET_DELIVERY_QUEUE_SIZE)
+checkin = OfflineCheckin(Settings.checkin_journal_path())
 
 # Conversation states
 STARTING, WAITING_NAME, WAITING_VK, WAITING_PAYMENT, READY_DASHBOARD, ADMIN_DASHBOARD, ADMIN_CHECKIN = range(1, 8)
@@ -66,6 +94,7 @@ BUTTON_MY_TICKET = "Мой билет"
 BUTTON_INFO = "Про ДММ2022"
 BUTTON_STATUS = "Как у меня дела"
 CALLBACK_BUTTON_GIFT_TICKET = "Gift"
+CALLBACK_BUTTON_USERS_PAGE = "Users"
 BUTTON_ADMIN_CHECKIN = "Регистрация"
 
 
@@ -80,8 +109,7 @@ def admin_keyboard(buttons=None):
 
 
 def get_default_keyboard_bottom(user: User, buttons=None, is_admin_in_convs=True):
-    convs = store.get_conversations(str(CONVERSATION_NAME))
-    state = convs.get(tuple([user.id]))
+    state = store.get_conversation(str(CONVERSATION_NAME), tuple([user.id]))
 
     if buttons is None:
         buttons = []
@@ -95,7 +123,7 @@ def get_default_keyboard_bottom(user: User, buttons=None, is_admin_in_convs=True
     key_board = [str(BUTTON_STATUS), str(BUTTON_INFO)]
 
     if user.admin:
-        in_admin_convs = store.get_conversations(str(CONVERSATION_ADMIN_NAME)).get(tuple([user.id]))
+        in_admin_convs = store.get_conversation(str(CONVERSATION_ADMIN_NAME), tuple([user.id]))
         if is_admin_in_convs and in_admin_convs:
             return admin_keyboard(buttons)
 
@@ -109,11 +137,29 @@ def get_default_keyboard_bottom(user: User, buttons=None, is_admin_in_convs=True
 
 
 def create_new_user(_id: int, _data: dict, status):
-    user = User.create_new(_id)
+    # Filled in locally first, so the record is created complete in one transaction
+    user = User()
     user.set_data(_data)
     user.status = status
-    user.save()
-    return user
+    return User.create_new(_id, user.tech_data())
+
+
+def read_qr_code_remote(image_bytes: bytes) -> Optional[str]:
+    try:
+        response = requests.post(url=QRCODE_SERVICE_API_URL, files={'file': ('code.jpg', image_bytes)},
+                                 timeout=QRCODE_REMOTE_TIMEOUT)
+        if response.status_code != 200:
+            return None
+
+        symbol = json.loads(response.content)[0]['symbol'][0]
+        if symbol['error']:
+            logging.log(logging.INFO, f"QR service error: {symbol['error']}")
+            return None
+
+        return symbol['data'].strip()
+    except (requests.RequestException, ValueError, LookupError, AttributeError):
+        logging.log(logging.ERROR, "QR service request failed")
+        return None
 
 
 # User actions (changes conversation state)
@@ -223,7 +269,7 @@ def action_set_vk(update: Update, context: CallbackContext) -> Optional[int]:
 
     for admin in User.admins():
         message = "Новая регистрация: " + user.pretty_html() + "\n"
-        context.bot.send_message(chat_id=admin.id, text=message, parse_mode=ParseMode.HTML)
+        outbound.send(admin.id, message, priority=PRIORITY_ADMIN, batchable=True, parse_mode=ParseMode.HTML)
 
     return WAITING_PAYMENT
 
@@ -232,40 +278,48 @@ def action_successful_payment_callback(update: Update, context: CallbackContext)
     payment = update.message.successful_payment
 
     try:
-        Ticket.get(payment.invoice_payload)
-        return process_successful_ticket(update, context)
-    except:
+        ticket = Ticket.cached(payment.invoice_payload)
+    except TelegramError:
         raise TelegramError(f"Пришла оплата на хер пойми что: {str(payment)}")
 
+    return process_successful_ticket(update, context, ticket)
 
-def process_successful_ticket(update: Update, context: CallbackContext):
+
+def process_successful_ticket(update: Update, context: CallbackContext, ticket: Ticket = None):
     payment = update.message.successful_payment
     user = User.get(update.effective_user.id)
-    ticket = Ticket.get(payment.invoice_payload)
-    purchase = TicketPurchase.create_new(update.message.successful_payment.provider_payment_charge_id)
-    purchase.currency = payment.currency
-    purchase.total_amount = payment.total_amount
-    purchase.set_ticket_info(ticket)
-    purchase.user = user
-    purchase.phone_number = helper.safe_list_get(payment.order_info, "phone_number")
-    purchase.email = helper.safe_list_get(payment.order_info, "email")
-    purchase.customer_name = helper.safe_list_get(payment.order_info, "name")
-    purchase.telegram_payment_charge_id = payment.telegram_payment_charge_id
-    purchase.provider_payment_charge_id = payment.provider_payment_charge_id
-    purchase.save()
+    ticket = ticket or Ticket.cached(payment.invoice_payload)
 
     try:
-        purchase.create_image()
-    except:
-        print("error")
+        purchase = TicketPurchase.create_new(payment.provider_payment_charge_id)
+    except TelegramError:
+        # The same payment redelivered or handled in parallel, only the first one gets a ticket. A redelivery
+        # finishes the stub of an earlier attempt whose commit below failed
+        purchase = TicketPurchase.claim_stub(payment.provider_payment_charge_id)
+        if not purchase:
+            logging.log(logging.WARNING, f"Duplicate payment {payment.provider_payment_charge_id} from {user.id}")
+            return None
 
-    # ticket.increase_price()
+    # Purchase details, user, stats and conversation state land in one multi-path update
+    with UnitOfWork() as uow:
+        purchase.currency = payment.currency
+        purchase.total_amount = payment.total_amount
+        purchase.set_ticket_info(ticket)
+        purchase.user = user
+        purchase.phone_number = helper.safe_list_get(payment.order_info, "phone_number")
+        purchase.email = helper.safe_list_get(payment.order_info, "email")
+        purchase.customer_name = helper.safe_list_get(payment.order_info, "name")
+        purchase.telegram_payment_charge_id = payment.telegram_payment_charge_id
+        purchase.provider_payment_charge_id = payment.provider_payment_charge_id
+        purchase.save(uow)
 
-    user.status = User.STATUS_READY
-    user.purchase_id = purchase.id
-    user.save()
+        # ticket.increase_price()
 
-    update_conversation(str(CONVERSATION_NAME), user, READY_DASHBOARD)
+        user.status = User.STATUS_READY
+        user.purchase_id = purchase.id
+        user.save(uow)
+
+        update_conversation(str(CONVERSATION_NAME), user, READY_DASHBOARD, uow)
 
     update.message.reply_text(state_texts[READY_DASHBOARD], reply_markup=ReplyKeyboardMarkup(
         get_default_keyboard_bottom(user), resize_keyboard=True),
@@ -273,21 +327,14 @@ def process_successful_ticket(update: Update, context: CallbackContext):
                               parse_mode=ParseMode.HTML)
 
     reply_html = purchase.pretty_html()
-    context.bot.send_message(
-        user.id,
-        text=reply_html,
-        disable_web_page_preview=True)
+    outbound.send(user.id, reply_html, priority=PRIORITY_PAYMENT, disable_web_page_preview=True)
 
-    try:
-        with open(f'images/{purchase.id}.png', 'rb') as f:
-            context.bot.send_photo(user.id, photo=f, timeout=50)
-    except:
-        logging.log(logging.ERROR, "File not found")
+    ticket_delivery.submit(purchase, user.id, bot=context.bot)
 
     for admin in User.admins():
         message = emojize(":money_bag:", use_aliases=True) + f" {user.real_name} ({user.username})" \
                                                              f" купил(а) '{purchase.ticket_name}' за {purchase.total_amount / 100} р."
-        context.bot.send_message(chat_id=admin.id, text=message)
+        outbound.send(admin.id, message, priority=PRIORITY_ADMIN, batchable=True)
 
     return READY_DASHBOARD
 
@@ -309,15 +356,8 @@ def show_my_ticket(update: Update, context: CallbackContext):
         update.message.reply_html(
             text=reply_html,
             disable_web_page_preview=True)
-        try:
-            with open(f'images/{purchase.id}.png', 'rb') as f:
-                pass
-        except:
-            purchase.create_image()
-
-        with open(f'images/{purchase.id}.png', 'rb') as f:
-            context.bot.send_photo(user.id, photo=f, timeout=50, reply_markup=ReplyKeyboardMarkup(
-                get_default_keyboard_bottom(user), resize_keyboard=True), )
+        ticket_delivery.send_ticket(purchase, user.id, reply_markup=ReplyKeyboardMarkup(
+            get_default_keyboard_bottom(user), resize_keyboard=True), bot=context.bot)
 
 
 def show_tickets(update: Update, context: CallbackContext):
@@ -361,7 +401,7 @@ def precheckout_callback(update: Update, _: CallbackContext) -> None:
     error_text = ""
 
     try:
-        ticket = Ticket.get(query.invoice_payload)
+        ticket = Ticket.cached(query.invoice_payload)
     except:
         # query.answer(ok=False, error_message=f"Нет билета с таким id:{query.invoice_payload}")
         error_text = f"Нет билета с таким id:{query.invoice_payload}"
@@ -408,8 +448,7 @@ def show_status(update: Update, context: CallbackContext) -> None:
 
 
 def show_state_text(update: Update, context: CallbackContext):
-    convs = store.get_conversations(str(CONVERSATION_NAME))
-    state = convs.get(tuple([update.effective_user.id]))
+    state = store.get_conversation(str(CONVERSATION_NAME), tuple([update.effective_user.id]))
     if state:
         update.message.reply_text(
             state_texts[state] + f"\nИспользуй кнопочки снизу, если что-то хочешь.", reply_markup=ReplyKeyboardMarkup(
@@ -438,39 +477,40 @@ def admin_action_dashboard(update: Update, context: CallbackContext):
     return ADMIN_DASHBOARD
 
 
+def is_checkin_admin(update: Update) -> bool:
+    # The offline index keeps the admins too, so a scan does not wait for the database
+    if checkin.loaded:
+        return checkin.is_admin(update.effective_user.id)
+
+    # Admins change rarely and the role list is cached, a scan costs only the activation itself
+    return any(str(admin.id) == str(update.effective_user.id) for admin in User.admins())
+
+
 def admin_action_checkin_photo_code(update: Update, context: CallbackContext):
     update.message.reply_text("Начинаю распознование...")
 
-    user = User.get(update.effective_user.id)
-    if not user or not user.admin:
+    if not is_checkin_admin(update):
         update.message.reply_text("Ну-ка! Куда полез!?")
         return None
 
-    file = context.bot.getFile(update.message.photo[-1].file_id)
-    response = requests.post(url=QRCODE_SERVICE_API_URL, params={'fileurl': file.file_path})
-    json_response = json.loads(response.content)
-    if response.status_code != 200:
-        update.message.reply_text(f"Чет не получилось тут qr-код найти, попробуй еще разок сфоткать.")
-        return None
+    file = context.bot.get_file(update.message.photo[-1].file_id)
+    image_bytes = bytes(file.download_as_bytearray())
 
-    try:
-        if json_response[0]['symbol'][0]['error']:
-            update.message.reply_text(
-                f"Чет не получилось тут qr-код найти, попробуй еще разок сфоткать. Детали: {json_response[0]['symbol'][0]['error']}")
-            return None
+    code = decoder.decode(image_bytes)
+    if not code and QRCODE_REMOTE_FALLBACK:
+        code = read_qr_code_remote(image_bytes)
 
-        code = json_response[0]['symbol'][0]['data'].strip()
-        admin_function_check_code(update, code)
+    if not code:
+        update.message.reply_text(f"Чет не получилось тут qr-код найти, попробуй еще разок сфоткать.")
+        return None
 
-    except:
-        update.message.reply_text(
-            f"Чет не получилось тут qr-код найти, попробуй еще разок сфоткать")
+    admin_function_check_code(update, code)
 
 
 def admin_action_checkin_text_code(update: Update, context: CallbackContext):
-    update.message.reply_text("Такс, начинаю сверять билет, в яме и песках это может быть не быстро...")
-    user = User.get(update.effective_user.id)
-    if not user or not user.admin:
+    if not checkin.loaded:
+        update.message.reply_text("Такс, начинаю сверять билет, в яме и песках это может быть не быстро...")
+    if not is_checkin_admin(update):
         update.message.reply_text("Ну-ка! Куда полез!?")
         return None
 
@@ -479,18 +519,49 @@ def admin_action_checkin_text_code(update: Update, context: CallbackContext):
 
 
 def admin_function_check_code(update: Update, code: str):
-    try:
-        ticket_purchase = TicketPurchase.get(code)
-        if ticket_purchase.activated:
-            update.message.reply_text(ticket_purchase.pretty_detailed_html())
-        else:
-            ticket_purchase.activated = datetime.now().timestamp()
-            ticket_purchase.save()
-            update.message.reply_html(f"<b>ФУК ЕЕЕЕЕ! Успешно зареган!</b>\n\n" +
-                                      ticket_purchase.pretty_detailed_html())
+    if checkin.loaded:
+        return admin_function_check_code_offline(update, code)
 
+    try:
+        ticket_purchase, activated = TicketPurchase.activate(code, datetime.now().timestamp())
     except:
         update.message.reply_text("Хмм... какая-то хуита. Нет такого билета.")
+        return
+
+    if activated:
+        update.message.reply_html(f"<b>ФУК ЕЕЕЕЕ! Успешно зареган!</b>\n\n" +
+                                  ticket_purchase.pretty_detailed_html())
+    else:
+        update.message.reply_text(ticket_purchase.pretty_detailed_html())
+
+
+def admin_function_check_code_offline(update: Update, code: str):
+    if not checkin.known(code):
+        # Bought or gifted after the index was loaded
+        try:
+            checkin.add(code, TicketPurchase.get(code).stored_data())
+        except:
+            update.message.reply_text("Хмм... какая-то хуита. Нет такого билета.")
+            return
+
+    entry, activated = checkin.check(code, update.effective_user.id)
+    if not entry:
+        # The index was dropped meanwhile, another admin entered check-in with the offline mode off
+        update.message.reply_text("Хмм... какая-то хуита. Нет такого билета.")
+        return
+
+    if activated:
+        update.message.reply_html(f"<b>ФУК ЕЕЕЕЕ! Успешно зареган!</b>\n\n" + entry.pretty_html())
+    else:
+        update.message.reply_text(entry.pretty_html())
+
+
+def notify_checkin_conflict(conflict: Conflict):
+    message = f"Билет {conflict.purchase_id} прошел дважды: у нас в " \
+              f"{datetime.fromtimestamp(conflict.activated).strftime('%H:%M:%S')}, " \
+              f"а в базе уже в {datetime.fromtimestamp(conflict.stored).strftime('%H:%M:%S')}"
+    for admin in User.admins():
+        outbound.send(admin.id, message, priority=PRIORITY_ADMIN, batchable=True)
 
 
 def admin_action_back_to_dashboard(update: Update, context: CallbackContext):
@@ -511,6 +582,17 @@ def admin_action_registration(update: Update, context: CallbackContext):
         update.message.reply_text("Ну-ка! Куда полез!?")
         return None
 
+    if Settings.offline_checkin():
+        try:
+            checkin.load(TicketPurchase.ref().get() or {}, [admin.id for admin in User.admins()])
+        except Exception as e:
+            # Keeps the index loaded before, if there is one
+            logging.log(logging.WARNING, f"Could not load the check-in index: {e}")
+        if checkin.loaded:
+            update.message.reply_text(checkin.statistics())
+    else:
+        checkin.clear()
+
     update.message.reply_text(
         'Отправь фотку билета или сам код (если распознаешь обычной камерой и у тебя не старый андроид)',
         reply_markup=ReplyKeyboardMarkup([[str(BUTTON_BACK)]], resize_keyboard=True, ), disable_web_page_preview=True)
@@ -542,6 +624,30 @@ def admin_show_stats(update: Update, context: CallbackContext):
     update.message.reply_text("Статистика")
     update.message.reply_text("Пользователи: \n" + User.statistics())
     update.message.reply_text("Покупки: \n" + TicketPurchase.statistics())
+    update.message.reply_text(ticket_delivery.statistics() + "\n" + outbound.statistics() + "\n" +
+                              context.dispatcher.update_queue.statistics() + "\n" + IdentityMap.statistics() +
+                              ("\n" + checkin.statistics() if checkin.loaded or checkin.pending else ""))
+
+
+def admin_show_metrics(update: Update, context: CallbackContext):
+    user = User.get(update.effective_user.id)
+    if not user or not user.admin:
+        update.message.reply_text("Ну-ка! Куда полез!?")
+        return None
+
+    metrics.dump(Settings.metrics_path())
+    update.message.reply_text("Обработчики по суммарному времени:\n" + metrics.summary())
+
+
+def admin_rebuild_stats(update: Update, context: CallbackContext):
+    user = User.get(update.effective_user.id)
+    if not user or not user.admin:
+        update.message.reply_text("Ну-ка! Куда полез!?")
+        return None
+
+    update.message.reply_text("Пересчитываю статистику по всем пользователям и покупкам...")
+    Stats.rebuild()
+    admin_show_stats(update, context)
 
 
 def admin_show_csv(update: Update, context: CallbackContext):
@@ -550,9 +656,31 @@ def admin_show_csv(update: Update, context: CallbackContext):
         update.message.reply_text("Ну-ка! Куда полез!?")
         return None
 
-    TicketPurchase.statistics_csv()
-    with open(f'purchases.csv', 'rb') as f:
-        update.message.reply_document(document=f)
+    # "Покупки CSV [gz] [cols=email,ticket_name] [2022-06-01 [2022-06-30]]"
+    options = update.message.text.split()[2:]
+    dates = []
+    columns = None
+    try:
+        for option in options:
+            if option.startswith("cols="):
+                columns = option[len("cols="):].split(",")
+            elif option != "gz":
+                dates.append(datetime.strptime(option, "%Y-%m-%d"))
+    except ValueError:
+        update.message.reply_text("Формат: Покупки CSV [gz] [cols=поле,поле] [YYYY-MM-DD [YYYY-MM-DD]]")
+        return None
+
+    unknown = [column for column in columns or [] if column not in TicketPurchase.CSV_FIELDNAMES]
+    if unknown:
+        update.message.reply_text(f"Нет таких полей: {', '.join(unknown)}\n"
+                                  f"Есть: {', '.join(TicketPurchase.CSV_FIELDNAMES)}")
+        return None
+
+    date_from = dates[0] if dates else None
+    date_to = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+
+    document = TicketPurchase.statistics_csv(columns, date_from, date_to, compress="gz" in options)
+    update.message.reply_document(document=document, filename=document.name)
 
 
 def admin_show_list(update: Update, context: CallbackContext):
@@ -565,26 +693,52 @@ def admin_show_list(update: Update, context: CallbackContext):
         update.message.reply_text("Неверная команда")
         return None
 
-    users = User.all()
+    text, markup = users_page()
+    update.message.reply_html(text, reply_markup=markup, disable_web_page_preview=True)
+    return None
 
-    i = 1
-    result = ""
-    for user in users:
-        if len(str(result + user.pretty_html(i))) > 4000:
-            update.message.reply_html(result, disable_web_page_preview=True)
-            result = user.pretty_html(f"/{str(user.id)} {i}")
-            continue
-        result = result + user.pretty_html(f"/{str(user.id)} {i}") + "\n"
-        i += 1
 
-    update.message.reply_html(
-        f"{result}\n\nВсего пользователей: " + str(len(users)), reply_markup=ReplyKeyboardMarkup(
-            admin_keyboard(),
-            resize_keyboard=True,
-        ), disable_web_page_preview=True, )
+def admin_show_list_page(update: Update, context: CallbackContext):
+    admin_user = User.get(update.effective_user.id)
+    update.callback_query.answer()
+    if not admin_user or not admin_user.admin:
+        update.callback_query.edit_message_text(text="Ну-ка! Куда полез!?")
+        return None
+
+    # "Users:<created>:<id>", the first page has no cursor
+    cursor = update.callback_query.data.split(':')[1:]
+    text, markup = users_page((float(cursor[0]), cursor[1]) if len(cursor) == 2 else None)
+    update.callback_query.edit_message_text(text=text, reply_markup=markup, parse_mode=ParseMode.HTML,
+                                            disable_web_page_preview=True)
     return None
 
 
+def users_page(cursor: Tuple[float, str] = None):
+    # One extra user tells whether there is a next page and where it starts
+    users = User.page_by_created(cursor, ADMIN_USERS_PAGE_SIZE + 1)
+    page, following = users[:ADMIN_USERS_PAGE_SIZE], users[ADMIN_USERS_PAGE_SIZE:]
+
+    text = "".join([user.pretty_html(f"/{str(user.id)}") for user in page])
+    text += f"\nВсего пользователей: {User.count()}"
+
+    buttons = []
+    if cursor is not None:
+        previous = User.page_before_created(cursor, ADMIN_USERS_PAGE_SIZE + 1)
+        if previous:
+            # Not more than a page before the cursor means the previous page is the first one
+            start = previous[-ADMIN_USERS_PAGE_SIZE] if len(previous) > ADMIN_USERS_PAGE_SIZE else None
+            buttons.append(InlineKeyboardButton(text="◀", callback_data=users_page_data(start)))
+    if following:
+        buttons.append(InlineKeyboardButton(text="▶", callback_data=users_page_data(following[0])))
+
+    return text, InlineKeyboardMarkup([buttons])
+
+
+def users_page_data(start: Optional[User]) -> str:
+    return f"{CALLBACK_BUTTON_USERS_PAGE}:{start.created_timestamp}:{start.id}" if start \
+        else f"{CALLBACK_BUTTON_USERS_PAGE}:"
+
+
 def admin_show_one_user(update: Update, context: CallbackContext):
     pattern = re.compile(r'^\/([0-9]+)$')
     id = pattern.search(update.message.text).group(1)
@@ -611,6 +765,35 @@ def admin_show_one_user(update: Update, context: CallbackContext):
         reply_markup=InlineKeyboardMarkup(markup_buttons))
 
 
+def admin_broadcast(update: Update, context: CallbackContext):
+    user = User.get(update.effective_user.id)
+    if not user or not user.admin:
+        update.message.reply_text("Ну-ка! Куда полез!?")
+        return None
+
+    parts = update.message.text.split(maxsplit=2)
+    if len(parts) < 3:
+        update.message.reply_text(
+            "Формат: /broadcast статус[,статус] текст\nСтатусы: " + ", ".join(User.status_to_pretty().keys()))
+        return None
+
+    try:
+        # The preview goes through the same HTML parsing as the broadcast, a broken text fails here once
+        update.message.reply_html(parts[2], disable_web_page_preview=True)
+    except BadRequest as e:
+        update.message.reply_text(f"Телеграм не понимает разметку: {e.message}. Экранируй < и & как &lt; и &amp;")
+        return None
+
+    try:
+        broadcast = Broadcast.create_new(user, parts[1].split(','), parts[2], BULK_SEND_SLEEP_STEP)
+    except TelegramError as e:
+        update.message.reply_text(e.message)
+        return None
+
+    broadcast.start()
+    update.message.reply_text(f"Рассылка {broadcast.id} запущена, пришлю отчет, когда закончится.")
+
+
 # User functions:
 
 
@@ -637,17 +820,16 @@ def admin_gift(update: Update, context: CallbackContext) -> None:
         reply_text = emojize(":man_detective:",
                              use_aliases=True) + " Возможно другой админ уже выдал билет " + user.pretty_html()
     else:
-        purchase = TicketPurchase.create_new_gift(admin_user)
-        purchase.user = user
-        purchase.save()
+        with UnitOfWork() as uow:
+            purchase = TicketPurchase.create_new_gift(admin_user, uow)
+            purchase.user = user
+            purchase.save(uow)
 
-        purchase.create_image()
+            user.status = User.STATUS_READY
+            user.purchase_id = purchase.id
+            user.save(uow)
 
-        user.status = User.STATUS_READY
-        user.purchase_id = purchase.id
-        user.save()
-
-        update_conversation(str(CONVERSATION_NAME), user, READY_DASHBOARD)
+            update_conversation(str(CONVERSATION_NAME), user, READY_DASHBOARD, uow)
 
         context.bot.send_message(user.id, state_texts[READY_DASHBOARD], reply_markup=ReplyKeyboardMarkup(
             get_default_keyboard_bottom(user),
@@ -655,6 +837,7 @@ def admin_gift(update: Update, context: CallbackContext) -> None:
         ),
                                  disable_web_page_preview=True,
                                  parse_mode=ParseMode.HTML)
+        ticket_delivery.submit(purchase, user.id, bot=context.bot)
 
         reply_text = emojize(":admission_tickets:", use_aliases=True) + " БИЛЕТ ВЫДАН " + user.pretty_html()
 
@@ -669,16 +852,20 @@ conv_admin_handler = ConversationHandler(
     states={
         ADMIN_DASHBOARD: [
             MessageHandler(Filters.regex(f'^{str(BUTTON_ADMIN_ALL)}'), admin_show_list),
-            MessageHandler(Filters.regex(f'^{str(BUTTON_ADMIN_CSV)}'), admin_show_csv),
+            MessageHandler(Filters.regex(f'^{str(BUTTON_ADMIN_CSV)}'), admin_show_csv, run_async=True),
             MessageHandler(Filters.regex(f'^{str(BUTTON_ADMIN_STATS)}'), admin_show_stats),
             MessageHandler(Filters.regex(f'^{str(BUTTON_ADMIN_CHECKIN)}$'), admin_action_registration),
             MessageHandler(Filters.regex(f'^{str(BUTTON_BACK)}$'), admin_action_back),
             CallbackQueryHandler(admin_gift, pattern=rf'^({str(CALLBACK_BUTTON_GIFT_TICKET)}.*$)'),
+            CallbackQueryHandler(admin_show_list_page, pattern=rf'^{str(CALLBACK_BUTTON_USERS_PAGE)}:.*$'),
+            CommandHandler('broadcast', admin_broadcast),
+            CommandHandler('rebuild_stats', admin_rebuild_stats, run_async=True),
+            CommandHandler('metrics', admin_show_metrics),
             MessageHandler(Filters.regex(f'^\/[0-9]+$'), admin_show_one_user)
         ],
         ADMIN_CHECKIN: [
             MessageHandler(Filters.regex(f'^{BUTTON_BACK}'), admin_action_back_to_dashboard),
-            MessageHandler(Filters.photo, admin_action_checkin_photo_code),
+            MessageHandler(Filters.photo, admin_action_checkin_photo_code, run_async=True),
             MessageHandler(Filters.text, admin_action_checkin_text_code),
         ]
     },
@@ -713,7 +900,7 @@ conv_handler = ConversationHandler(
             MessageHandler(Filters.successful_payment, action_successful_payment_callback),
         ],
         READY_DASHBOARD: [
-            MessageHandler(Filters.regex(f'^{BUTTON_MY_TICKET}$'), show_my_ticket),
+            MessageHandler(Filters.regex(f'^{BUTTON_MY_TICKET}$'), show_my_ticket, run_async=True),
         ]
     },
     fallbacks=[],
@@ -724,22 +911,14 @@ conv_handler = ConversationHandler(
 )
 
 
-def update_conversation(conversation_name: str, user: User, state: int):
-    store.update_conversation(conversation_name, tuple([user.id]), state)
-    refresh_conversations(conv_handler)
-
-
-def refresh_conversations(handler: ConversationHandler):
-    handler.conversations = store.get_conversations(str(CONVERSATION_NAME))
+def update_conversation(conversation_name: str, user: User, state: int, uow: UnitOfWork = None):
+    # The handler's conversations are the store's dict, patched in place
+    store.update_conversation(conversation_name, tuple([user.id]), state, uow)
 
 
 # Main endpoint
 
-def main() -> None:
-    updater = Updater(Settings.bot_token(), persistence=store)
-    dispatcher = updater.dispatcher
-
-    # Add handlers
+def add_handlers(dispatcher: Dispatcher) -> None:
     dispatcher.add_handler(MessageHandler(Filters.regex(f'^{str(BUTTON_STATUS)}$'), show_status))
     dispatcher.add_handler(MessageHandler(Filters.regex(f'^{str(BUTTON_INFO)}'), show_info))
 
@@ -750,10 +929,57 @@ def main() -> None:
     dispatcher.add_handler(MessageHandler(Filters.successful_payment, action_successful_payment_callback))
     dispatcher.add_handler(MessageHandler(Filters.text, show_state_text))
     dispatcher.add_error_handler(error_handler)
+    dispatcher.add_handler(TypeHandler(Update, release_identity_map), group=IDENTITY_MAP_GROUP)
+
+
+def create_updater(update_queue: UpdateQueue) -> Updater:
+    workers = Settings.bot_workers()
+    api_url = Settings.bot_api_url()
+    # run_async workers, the ticket delivery pool and the outbound queue all send through this bot
+    request = Request(con_pool_size=workers + TICKET_DELIVERY_WORKERS + 4)
+    bot = Bot(Settings.bot_token(), base_url=f"{api_url}/bot", base_file_url=f"{api_url}/file/bot", request=request)
+
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, update_queue, workers=workers, job_queue=job_queue, persistence=store,
+                            context_types=ContextTypes(context=BotContext))
+    job_queue.set_dispatcher(dispatcher)
+    add_handlers(dispatcher)
+    # Workers belong to the dispatcher, Updater refuses its own default alongside one
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def start_updater(updater: Updater) -> None:
+    if Settings.bot_mode() == Settings.MODE_WEBHOOK:
+        path = Settings.webhook_path()
+        updater.start_webhook(listen=Settings.webhook_listen(), port=Settings.webhook_port(), url_path=path,
+                              webhook_url=f"{Settings.webhook_url()}/{path}", max_connections=WEBHOOK_MAX_CONNECTIONS)
+    else:
+        updater.start_polling()
 
-    updater.start_polling()
+
+def main() -> None:
+    update_queue = UpdateQueue(Settings.update_queue_size())
+    updater = create_updater(update_queue)
+    metrics.instrument(updater.dispatcher)
+    metrics.instrument_storage(type(store.users), type(store.users.order_by_key()))
+    metrics.add_collector(update_queue.render)
+    metrics.start_dumping(Settings.metrics_path(), METRICS_DUMP_INTERVAL)
+
+    Settings.watch()
+    Ticket.watch_catalog()
+    ticket_delivery.start(updater.bot)
+    outbound.start(updater.bot)
+    checkin.start(TicketPurchase.store_activations, notify_checkin_conflict)
+    for broadcast in Broadcast.unfinished():
+        broadcast.start()
+
+    start_updater(updater)
     updater.idle()
 
+    checkin.stop()
+    ticket_delivery.stop()
+    outbound.stop()
+
 
 if __name__ == '__main__':
     main()
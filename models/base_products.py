@@ -1,82 +1,45 @@
 import collections
+import time
 from abc import ABC, abstractmethod
-from firebase_admin.db import Reference
+from threading import Lock
+from typing import NamedTuple
 from telegram import TelegramError
-from utils import helper
+from models.fields import Field, Model
+from persistence.reference import Reference
+from utils.identity_map import IdentityMap
 
 
-class BaseProduct(ABC):
+class CatalogSnapshot(NamedTuple):
+    version: int
+    expires: float
+    products: collections.OrderedDict
 
-    def __init__(self):
-        self._id = None
-        self._data = {}
+
+class BaseProduct(Model, ABC):
+    __slots__ = ()
+
+    CATALOG_TTL = 300
+
+    # Product class -> CatalogSnapshot, replaced as a whole so readers never see a half-built catalog
+    _catalogs = {}
+    _catalogs_lock = Lock()
 
     @classmethod
     @abstractmethod
     def ref(cls) -> Reference:
         pass
 
-    @property
-    def id(self):
-        return self._id
-
-    @id.setter
-    def id(self, _id: int):
-        self._id = _id
-
-    @property
-    def photo(self):
-        return helper.safe_list_get(self._data, "photo")
-
-    @photo.setter
-    def photo(self, photo: str):
-        raise TelegramError("Photo is being changed only via Firebase store")
-
-    @property
-    def description(self):
-        return helper.safe_list_get(self._data, "description")
-
-    @description.setter
-    def description(self, description: str):
-        raise TelegramError("Description is being changed only via Firebase store")
-
-    @property
-    def price(self):
-        return helper.safe_list_get(self._data, "price")
-
-    @price.setter
-    def price(self, price: int):
-        raise TelegramError("Price is being changed only via Firebase store")
-
-    @property
-    def order(self):
-        return helper.safe_list_get(self._data, "order")
-
-    @order.setter
-    def order(self, order: int):
-        raise TelegramError("Order is being changed only via Firebase store")
-
-    @property
-    def type(self):
-        return helper.safe_list_get(self._data, "type")
-
-    @type.setter
-    def type(self, _type: str):
-        raise TelegramError("Type is being changed only via Firebase store")
+    photo = Field("", readonly="Photo is being changed only via Firebase store")
+    description = Field("", readonly="Description is being changed only via Firebase store")
+    price = Field("", readonly="Price is being changed only via Firebase store")
+    order = Field("", readonly="Order is being changed only via Firebase store")
+    type = Field("", readonly="Type is being changed only via Firebase store")
 
     def save(self):
         self.ref().child(self._id).update(self._data)
 
-    def tech_data(self):
-        return self._data
-
-
     # Functions
 
-    @type.setter
-    def type(self, _type: str):
-        raise TelegramError("Type is being changed only via Firebase store")
-
     def load(self):
         if not self._id:
             raise TelegramError(f"Отсутстует id товара")
@@ -85,7 +48,7 @@ class BaseProduct(ABC):
         if not _data:
             raise TelegramError(f"Нет данных по товару с id: {self._id}")
 
-        self._data = _data
+        self.set_stored(_data)
 
     def pretty_html(self, index: int = None):
         return "<b>{}{}</b>\n{}".format(str(index) + ". " if index else "", self.id, self.description)
@@ -103,15 +66,59 @@ class BaseProduct(ABC):
     def get(cls, _id: str, data=None):
         # if not cls.exists(_id):
         #     raise TelegramError(f"Нет товара с id {_id}")
+        if not data:
+            return IdentityMap.lookup(cls, _id, lambda: cls.load_new(_id))
+
         instance = cls()
         instance.id = _id
-        if data:
-            instance._data = data
-        else:
-            instance.load()
+        instance.set_stored(data)
+        return instance
 
+    @classmethod
+    def load_new(cls, _id: str):
+        instance = cls()
+        instance.id = _id
+        instance.load()
         return instance
 
+    @classmethod
+    def cached(cls, _id: str):
+        product = cls.catalog().get(_id)
+        if not product:
+            raise TelegramError(f"Нет товара с id {_id}")
+        return product
+
+    @classmethod
+    def catalog(cls) -> collections.OrderedDict:
+        snapshot = BaseProduct._catalogs.get(cls)
+        if not snapshot or snapshot.expires < time.monotonic():
+            snapshot = cls.refresh_catalog(snapshot.version if snapshot else 0)
+        return snapshot.products
+
+    @classmethod
+    def catalog_version(cls) -> int:
+        snapshot = BaseProduct._catalogs.get(cls)
+        return snapshot.version if snapshot else 0
+
+    @classmethod
+    def refresh_catalog(cls, seen_version: int = None) -> CatalogSnapshot:
+        with BaseProduct._catalogs_lock:
+            snapshot = BaseProduct._catalogs.get(cls)
+            version = snapshot.version if snapshot else 0
+            # Another thread already refreshed the version the caller saw
+            if seen_version is not None and version != seen_version:
+                return snapshot
+
+            products = collections.OrderedDict((product.id, product) for product in cls.all())
+            snapshot = CatalogSnapshot(version + 1, time.monotonic() + cls.CATALOG_TTL, products)
+            BaseProduct._catalogs[cls] = snapshot
+            return snapshot
+
+    @classmethod
+    def watch_catalog(cls):
+        # Products are edited in the Firebase console, reload on every change instead of waiting for the TTL
+        return cls.ref().listen(lambda event: cls.refresh_catalog())
+
     @classmethod
     def all(cls, sort: str = "order", reverse=True):
         fb_goods = cls.ref().order_by_child(sort).get() if sort else cls.ref().get()
@@ -0,0 +1,188 @@
+import logging
+import time
+from datetime import datetime
+from threading import Event, Lock, Thread
+from typing import List
+
+from telegram import ParseMode, TelegramError
+
+from models.users import User
+from persistence.firebase_persistence import FirebasePersistence
+from persistence.reference import Reference
+from utils import helper
+from utils.outbound_queue import outbound, PRIORITY_ADMIN, PRIORITY_BULK
+
+store = FirebasePersistence()
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a page to go out. If the outbound queue stopped, the rest of the page counts as failed
+PAGE_TIMEOUT = 300
+
+
+class Broadcast:
+    """Message to every user in the given statuses, resumable from the last checkpointed page."""
+
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+
+    def __init__(self):
+        self._id = None
+        self._data = {}
+        self._lock = Lock()
+
+    @classmethod
+    def ref(cls) -> Reference:
+        return store.broadcasts
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def text(self):
+        return helper.safe_list_get(self._data, "text")
+
+    @property
+    def statuses(self) -> List[str]:
+        return helper.safe_list_get(self._data, "statuses", [])
+
+    @property
+    def issuer(self):
+        return helper.safe_list_get(self._data, "issuer", None)
+
+    @property
+    def status(self):
+        return helper.safe_list_get(self._data, "status")
+
+    @property
+    def page_size(self):
+        return helper.safe_list_get(self._data, "page_size", 25)
+
+    @property
+    def last_key(self):
+        return helper.safe_list_get(self._data, "last_key", None)
+
+    @property
+    def last_status(self):
+        return helper.safe_list_get(self._data, "last_status", None)
+
+    @property
+    def sent(self):
+        return helper.safe_list_get(self._data, "sent", 0)
+
+    @property
+    def failed(self):
+        return helper.safe_list_get(self._data, "failed", 0)
+
+    @property
+    def elapsed(self):
+        return helper.safe_list_get(self._data, "elapsed", 0.0)
+
+    def save(self):
+        self.ref().child(self._id).update(self._data)
+
+    # Functions
+
+    def start(self):
+        Thread(target=self.run, name=f"broadcast_{self._id}", daemon=True).start()
+
+    def run(self):
+        logger.info(f"Broadcast {self._id} starts after user {self.last_key} ({self.last_status})")
+        for status, users in self._pages():
+            started = time.monotonic()
+            self._send_page(users)
+
+            self._data["last_status"] = status
+            self._data["last_key"] = users[-1].id
+            self._data["elapsed"] = self.elapsed + time.monotonic() - started
+            self.save()
+
+        self._data["status"] = Broadcast.STATUS_DONE
+        self._data["finished"] = datetime.now().timestamp()
+        self.save()
+
+        if self.issuer:
+            outbound.send(self.issuer, self.report(), priority=PRIORITY_ADMIN)
+
+    def report(self):
+        total = self.sent + self.failed
+        speed = total / self.elapsed if self.elapsed else 0
+        return f"Рассылка {self._id} ({', '.join(self.statuses)}): отправлено {self.sent}, ошибок {self.failed}, " \
+               f"{round(speed, 1)} сообщ./с за {round(self.elapsed, 1)} с"
+
+    def _pages(self):
+        """Recipients page by page, each page one indexed query per status from the checkpointed key."""
+        done = self.statuses.index(self.last_status) if self.last_status in self.statuses else 0
+        for index, status in enumerate(self.statuses[done:], done):
+            last_key = self.last_key if index == done and status == self.last_status else None
+            while True:
+                users = User.page_by_status(status, last_key, self.page_size)
+                if users:
+                    yield status, users
+                if len(users) < self.page_size:
+                    break
+                last_key = users[-1].id
+
+    def _send_page(self, users: List[User]):
+        if not users:
+            return
+
+        pending = [len(users)]
+        done = Event()
+
+        def on_sent(ok: bool, error: Exception):
+            with self._lock:
+                if not pending[0]:
+                    # Already counted as failed when the page timed out
+                    return
+                key = "sent" if ok else "failed"
+                self._data[key] = helper.safe_list_get(self._data, key, 0) + 1
+                pending[0] -= 1
+                if not pending[0]:
+                    done.set()
+
+        for user in users:
+            outbound.send(user.id, self.text, priority=PRIORITY_BULK, callback=on_sent,
+                          parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+        # Checkpoint only after the whole page is out, a restart resends at most one page
+        if not done.wait(PAGE_TIMEOUT):
+            with self._lock:
+                logger.error(f"Broadcast {self._id}: {pending[0]} messages were not sent in {PAGE_TIMEOUT}s")
+                self._data["failed"] = self.failed + pending[0]
+                pending[0] = 0
+
+    @staticmethod
+    def create_new(issuer: User, statuses: List[str], text: str, page_size: int):
+        for status in statuses:
+            if status not in User.status_to_pretty():
+                raise TelegramError(f"Нет такого статуса: {status}")
+
+        data = {
+            'text': text,
+            'statuses': statuses,
+            'issuer': issuer.id,
+            'page_size': page_size,
+            'status': Broadcast.STATUS_RUNNING,
+            'sent': 0,
+            'failed': 0,
+            'elapsed': 0.0,
+            'created': datetime.now().timestamp(),
+        }
+        broadcast = Broadcast()
+        broadcast._id = Broadcast.ref().push(data).key
+        broadcast._data = data
+        return broadcast
+
+    @staticmethod
+    def unfinished():
+        fb_broadcasts = Broadcast.ref().order_by_child("status").equal_to(Broadcast.STATUS_RUNNING).get()
+        fb_broadcasts = fb_broadcasts if fb_broadcasts else {}
+
+        broadcasts = []
+        for _id in fb_broadcasts:
+            broadcast = Broadcast()
+            broadcast._id = _id
+            broadcast._data = fb_broadcasts[_id]
+            broadcasts.append(broadcast)
+        return broadcasts
@@ -0,0 +1,163 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from telegram import TelegramError
+
+MISSING = object()
+
+
+class Field:
+    """Model attribute stored under a key of the model's _data dict."""
+
+    __slots__ = ("key", "default", "readonly")
+
+    def __init__(self, default=None, readonly: str = None, key: str = None):
+        self.key = key
+        self.default = default
+        self.readonly = readonly
+
+    def __set_name__(self, owner, name):
+        if not self.key:
+            self.key = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._data.get(self.key, self.default)
+
+    def __set__(self, instance, value):
+        if self.readonly:
+            raise TelegramError(self.readonly)
+        instance._set(self.key, value)
+
+
+class TimestampField(Field):
+    """Unix timestamp shown as a formatted date, formatted once per stored value."""
+
+    __slots__ = ("suffix",)
+
+    def __init__(self, suffix: str = "", readonly: str = None, key: str = None):
+        super().__init__(None, readonly, key)
+        self.suffix = suffix
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        timestamp = instance._data.get(self.key)
+        if not timestamp:
+            return None
+
+        if instance._formatted is None:
+            instance._formatted = {}
+        cached = instance._formatted.get(self.key)
+        if cached and cached[0] == timestamp:
+            return cached[1]
+
+        formatted = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') + self.suffix
+        instance._formatted[self.key] = (timestamp, formatted)
+        return formatted
+
+
+class Model(ABC):
+    """Record backed by a plain dict, with the original values of changed keys kept for dirty tracking."""
+
+    __slots__ = ("_id", "_data", "_original", "_formatted")
+
+    def __init__(self):
+        self._id = None
+        self._data = {}
+        # key -> value as stored before the first change, None while the record is clean
+        self._original = None
+        self._formatted = None
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, _id):
+        self._id = _id
+
+    @property
+    def dirty(self) -> dict:
+        if not self._original:
+            return {}
+        return {key: self._data.get(key) for key, value in self._original.items()
+                if value != self._data.get(key, MISSING)}
+
+    def tech_data(self):
+        return self._data
+
+    @classmethod
+    @abstractmethod
+    def ref(cls):
+        pass
+
+    def path(self) -> str:
+        """Location of the record relative to the database root."""
+        return self.ref().child(str(self._id)).path.strip("/")
+
+    def stats_changes(self, old: dict, new: dict) -> dict:
+        return {}
+
+    def changes(self) -> dict:
+        """Multi-path update, relative to the database root, for the keys changed since the last save."""
+        path = self.path()
+        changes = {f"{path}/{key}": value for key, value in self.dirty.items()}
+        if changes:
+            changes.update(self.stats_changes(self.stored_data(), self._data))
+        return changes
+
+    @classmethod
+    def insert(cls, _id, data: dict, error: str):
+        """Stores the complete new record in a transaction that fails when the id is already taken.
+
+        On Firebase the transaction is a GET with an ETag and a PUT conditional on it. The stats counters
+        of the record follow in a separate update, /rebuild_stats recounts them if that one is lost.
+        """
+
+        def create(current):
+            # Raising aborts the transaction, a concurrent create of the same id gets here on its retry
+            if current:
+                raise TelegramError(error)
+            return data
+
+        instance = cls()
+        instance.id = _id
+        instance.set_stored(cls.ref().child(str(_id)).transaction(create))
+
+        changes = instance.stats_changes({}, instance.stored_data())
+        if changes:
+            # Imported here, models.fields itself must not connect to the storage
+            from persistence.unit_of_work import UnitOfWork
+            with UnitOfWork() as uow:
+                uow.add(changes)
+        return instance
+
+    def set_stored(self, data: dict):
+        self._data = data
+        self._original = None
+        self._formatted = None
+
+    def stored_data(self) -> dict:
+        if not self._original:
+            return self._data
+
+        data = dict(self._data)
+        for key, value in self._original.items():
+            if value is MISSING:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        return data
+
+    def mark_stored(self):
+        self._original = None
+
+    def _set(self, key: str, value):
+        if self._original is None:
+            self._original = {}
+        if key not in self._original:
+            self._original[key] = self._data.get(key, MISSING)
+        self._data[key] = value
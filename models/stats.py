@@ -0,0 +1,80 @@
+import collections
+
+from persistence.firebase_persistence import FirebasePersistence
+from persistence.reference import Reference
+from utils import helper
+
+store = FirebasePersistence()
+
+
+class Stats:
+    """Running aggregates kept next to the data and updated in the same multi-path write.
+
+    Deltas come from the snapshot the saving process read, not from what is stored at the moment of the
+    write: two concurrent saves of the same record from one status both count it. That drift is accepted,
+    rebuild() recounts everything.
+    """
+
+    PATH = "stats"
+
+    @staticmethod
+    def ref() -> Reference:
+        return store.stats
+
+    @staticmethod
+    def user_changes(old: dict, new: dict) -> dict:
+        old_status = helper.safe_list_get(old, "status", None)
+        new_status = helper.safe_list_get(new, "status", None)
+        if old_status == new_status:
+            return {}
+
+        changes = {}
+        if old_status:
+            changes[f"{Stats.PATH}/users/{old_status}"] = helper.increment(-1)
+        if new_status:
+            changes[f"{Stats.PATH}/users/{new_status}"] = helper.increment(1)
+        return changes
+
+    @staticmethod
+    def purchase_changes(old: dict, new: dict) -> dict:
+        changes = collections.defaultdict(int)
+
+        # A purchase is counted once it has a ticket and an amount
+        for data, sign in ((old, -1), (new, 1)):
+            ticket_name = helper.safe_list_get(data, "ticket_name", None)
+            if ticket_name:
+                changes[f"{Stats.PATH}/purchases/{ticket_name}/count"] += sign
+                changes[f"{Stats.PATH}/purchases/{ticket_name}/amount"] += \
+                    sign * (helper.safe_list_get(data, "total_amount", 0) or 0)
+
+        if not helper.safe_list_get(old, "activated", None) and helper.safe_list_get(new, "activated", None):
+            changes[f"{Stats.PATH}/activated"] += 1
+
+        return {path: helper.increment(delta) for path, delta in changes.items() if delta}
+
+    @staticmethod
+    def get() -> dict:
+        return Stats.ref().get() or {}
+
+    @staticmethod
+    def rebuild() -> dict:
+        from models.ticket_purchases import TicketPurchase
+        from models.users import User
+
+        users = collections.defaultdict(int)
+        for user in User.all(sort=None):
+            if user.status:
+                users[user.status] += 1
+
+        purchases = collections.defaultdict(lambda: {'count': 0, 'amount': 0})
+        activated = 0
+        for purchase in TicketPurchase.all(sort=None, reverse=False):
+            if purchase.ticket_name:
+                purchases[purchase.ticket_name]['count'] += 1
+                purchases[purchase.ticket_name]['amount'] += purchase.total_amount or 0
+            if purchase.activated:
+                activated += 1
+
+        stats = {'users': dict(users), 'purchases': dict(purchases), 'activated': activated}
+        Stats.ref().set(stats)
+        return stats
@@ -1,93 +1,75 @@
 import collections
+import io
+import logging
 import re
 import uuid
-import csv
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
 
-from firebase_admin.db import Reference
 from telegram import TelegramError
 
 from models.base_purchases import BasePurchase
+from models.fields import Field, TimestampField
+from models.stats import Stats
 from persistence.firebase_persistence import FirebasePersistence
+from persistence.reference import Reference
+from persistence.unit_of_work import UnitOfWork
 from models.tickets import Ticket
 from models.users import User
 from utils import helper
-from PIL import Image, ImageDraw, ImageFont
-import pyqrcode
+from utils.csv_export import CsvExporter
+from utils.ticket_renderer import TicketRenderer
 
 store = FirebasePersistence()
+renderer = TicketRenderer()
+logger = logging.getLogger(__name__)
 
 
 class TicketPurchase(BasePurchase):
+    __slots__ = ()
 
     @classmethod
     def ref(cls) -> Reference:
         return store.purchases
 
-    @property
-    def ticket_name(self):
-        return helper.safe_list_get(self._data, "ticket_name", None)
-
-    @ticket_name.setter
-    def ticket_name(self, ticket_name: str):
-        raise TelegramError("Direct setter for ticket name is denied")
-
-    @property
-    def ticket_base_price(self):
-        return helper.safe_list_get(self._data, "ticket_base_price", None)
-
-    @ticket_base_price.setter
-    def ticket_base_price(self, ticket_base_price: str):
-        raise TelegramError("Direct setter for ticket_base_price is denied")
-
-    @property
-    def ticket_description(self):
-        return helper.safe_list_get(self._data, "ticket_description", None)
-
-    @ticket_description.setter
-    def ticket_description(self, ticket_description: str):
-        raise TelegramError("Direct setter for ticket_description is denied")
+    ticket_name = Field(readonly="Direct setter for ticket name is denied")
+    ticket_base_price = Field(readonly="Direct setter for ticket_base_price is denied")
+    ticket_description = Field(readonly="Direct setter for ticket_description is denied")
+    activated = TimestampField(suffix=" UTC")
+    # Telegram file_id of the uploaded ticket image, later sends reference it instead of uploading
+    photo_file_id = Field()
 
     @property
     def user(self):
-        _id = helper.safe_list_get(self._data, "user", None)
+        _id = self._data.get("user")
         return User.get(_id) if _id else None
 
     @user.setter
     def user(self, user: User):
-        self._data["user"] = user.id
-        self._data["user_name"] = user.real_name
-        self._data["user_username"] = user.username
+        self._set("user", user.id)
+        self._set("user_name", user.real_name)
+        self._set("user_username", user.username)
 
     @property
     def issuer(self):
-        _id = helper.safe_list_get(self._data, "issuer", None)
+        _id = self._data.get("issuer")
         return User.get(_id) if _id else None
 
     @issuer.setter
     def issuer(self, issuer: User):
-        self._data["issuer"] = issuer.id
-        self._data["issuer_name"] = issuer.real_name
-        self._data["issuer_username"] = issuer.username
-
-    # activated
-    @property
-    def activated(self):
-        timestamp = helper.safe_list_get(self._data, "activated")
-        if timestamp:
-            return datetime.fromtimestamp(timestamp).strftime(
-                '%Y-%m-%d %H:%M:%S') + " UTC"
-
-    @activated.setter
-    def activated(self, activated: float):
-        self._data["activated"] = activated
+        self._set("issuer", issuer.id)
+        self._set("issuer_name", issuer.real_name)
+        self._set("issuer_username", issuer.username)
 
     # Functions
 
     def set_ticket_info(self, ticket: Ticket):
-        self._data["ticket_name"] = ticket.id
-        self._data["ticket_base_price"] = ticket.price
-        self._data["ticket_description"] = ticket.description
+        self._set("ticket_name", ticket.id)
+        self._set("ticket_base_price", ticket.price)
+        self._set("ticket_description", ticket.description)
+
+    def stats_changes(self, old: dict, new: dict) -> dict:
+        return Stats.purchase_changes(old, new)
 
     def pretty_html(self, index: int = None):
         return f"{self.ticket_name}!\n" \
@@ -100,41 +82,34 @@ class TicketPurchase(BasePurchase):
                f"Чо там внутри: {helper.safe_list_get(self._data, 'ticket_description')}\n" \
                f"Активирован: {self.activated if self.activated else 'нет'}"
 
-    def create_image(self):
-        # generate qr
-        big_code = pyqrcode.create(self.id)
-        big_code.png('tmp_code.png', scale=20, module_color=[0, 0, 0, 128], background=(255, 255, 255))
-
-        qr = Image.open("tmp_code.png")
-        ticket_width = qr.width + 60
-
-        # get qr img
-        qr_img = Image.new('RGB', (ticket_width, ticket_width), color=(44, 44, 212))
-        qr_img.paste(qr, (30, 30))
-
-        # get text img
-        text_img = Image.new('RGB', (ticket_width, 420), color=(44, 44, 212))
-        d = ImageDraw.Draw(text_img)
-        master_font = ImageFont.FreeTypeFont('fonts/HelveticaBlack.ttf', 60, encoding="utf-8")
-        d.text((50, 50), "DMM 2022", fill=(255, 255, 255), font=master_font)
-        slave_font = ImageFont.FreeTypeFont('fonts/arial.ttf', 40, encoding="utf-8")
-        d.text((60, 130), 'Имя: ' + self.user.real_name, fill=(255, 255, 255), font=slave_font)
-        d.text((60, 180), 'Тип: ' + self.ticket_name, fill=(255, 255, 255), font=slave_font)
-        d.text((60, 230), 'Стоимость: ' + str(self.total_amount / 100) + ' рублей', fill=(255, 255, 255), font=slave_font)
-        d.text((60, 280), 'Дата: ' + self.created + ' (UTC)', fill=(255, 255, 255), font=slave_font)
-
-        # get ticket size
-        ticket_height = qr_img.height + text_img.height
-
-        # concatenate text and qr
-        purchase = Image.new('RGB', (ticket_width, ticket_height))
-        purchase.paste(text_img, (0, 0))
-        purchase.paste(qr_img, (0, text_img.height))
-
-        purchase.save(f'images/{self.id}.png')
+    def create_image(self) -> io.BytesIO:
+        name = helper.safe_list_get(self._data, "user_name", None) or self.user.real_name
+        return renderer.render_png(self.id, [
+            'Имя: ' + name,
+            'Тип: ' + self.ticket_name,
+            'Стоимость: ' + str(self.total_amount / 100) + ' рублей',
+            'Дата: ' + self.created + ' (UTC)',
+        ])
+
+    def photo(self) -> Union[str, io.BytesIO]:
+        """What to pass to send_photo: the file_id, else the saved image, else a freshly rendered one."""
+        if self.photo_file_id:
+            return self.photo_file_id
+
+        try:
+            with open(f'images/{self.id}.png', 'rb') as f:
+                return io.BytesIO(f.read())
+        except OSError:
+            return self.create_image()
+
+    def save_image(self, path: str = None) -> str:
+        path = path or f'images/{self.id}.png'
+        with open(path, 'wb') as f:
+            f.write(self.create_image().getvalue())
+        return path
 
     @staticmethod
-    def create_new_gift(issuer: User):
+    def create_new_gift(issuer: User, uow: UnitOfWork = None):
         _id = str(uuid.uuid4())
         purchase = TicketPurchase.create_new(_id)
         purchase.issuer = issuer
@@ -147,52 +122,110 @@ class TicketPurchase(BasePurchase):
         purchase.currency = "RUB"
         purchase.total_amount = ticket.price * 100
         purchase.set_ticket_info(ticket)
-        purchase.save()
+        purchase.save(uow)
 
         return purchase
 
+    @staticmethod
+    def activate(_id: str, timestamp: float) -> Tuple["TicketPurchase", bool]:
+        """Activates the ticket with a conditional write unless it is activated already.
+
+        Returns the purchase and whether this call activated it, raises TelegramError for an unknown ticket.
+        A successful activation costs four requests on Firebase, see _set_activated, the last one the stats
+        counter. It is not atomic with the activation, /rebuild_stats recounts it if that write is lost.
+        """
+        data, activated = TicketPurchase._set_activated(_id, timestamp)
+        if not data:
+            raise TelegramError(f"Нет данных по покупке с id: {_id}")
+        if not activated:
+            return TicketPurchase.get(_id, data), False
+
+        new = dict(data, activated=timestamp)
+        store.root.update(Stats.purchase_changes(data, new))
+        return TicketPurchase.get(_id, new), True
+
+    @staticmethod
+    def store_activations(activations: Dict[str, float]) -> Dict[str, float]:
+        """Stores activation times made offline, returns the tickets already activated at another time."""
+        conflicts = {}
+        activated = 0
+        for _id, timestamp in activations.items():
+            data, stored = TicketPurchase._set_activated(_id, timestamp)
+            if stored:
+                activated += 1
+            elif not data:
+                logger.warning(f"Ticket {_id} was deleted before its offline activation was stored")
+            elif data["activated"] != timestamp:
+                # The same time means this activation was stored before, by a sync that did not finish
+                conflicts[_id] = data["activated"]
+
+        if activated:
+            store.root.update({f"{Stats.PATH}/activated": helper.increment(activated)})
+        return conflicts
+
+    @staticmethod
+    def _set_activated(_id: str, timestamp: float) -> Tuple[Optional[dict], bool]:
+        """Sets activated on an existing purchase that has none yet.
+
+        Returns the purchase as it was before and whether activated was set. On Firebase that is a GET of the
+        purchase, then for a ticket not activated yet a transaction on its activated child alone: a GET with
+        an ETag and a conditional PUT. A missing purchase is never written, so there are no orphan records.
+        """
+        data = TicketPurchase.ref().child(_id).get()
+        if not data or data.get("activated"):
+            return data, False
+
+        previous = []
+
+        def activate(current):
+            # Raising aborts the transaction, a concurrent activation of the same ticket gets here on its retry
+            previous[:] = [current]
+            if current:
+                raise TelegramError(f"Билет {_id} уже активирован")
+            return timestamp
+
+        try:
+            TicketPurchase.ref().child(_id).child("activated").transaction(activate)
+        except TelegramError:
+            return dict(data, activated=previous[0]), False
+        return data, True
+
     @staticmethod
     def by_user(user: User):
-        return list(
-            filter(lambda purchase: purchase._data["user"] and purchase._data["user"] == user.id, TicketPurchase.all()))
+        return TicketPurchase.by_field("user", user.id)
 
     @staticmethod
     def statistics():
-        purchase_list = TicketPurchase.all()
-        groups = collections.defaultdict(dict)
-        groups['Билет ДММ2022'] = {'count': 0, 'items': []}
+        stats = Stats.get()
+        groups = collections.OrderedDict()
+        groups['Билет ДММ2022'] = {'count': 0, 'amount': 0}
+        groups.update(helper.safe_list_get(stats, "purchases", {}))
+
         taxes = 0
         total = 0
-        for obj in purchase_list:
-            total = total + obj.total_amount
-            taxes = taxes + obj.total_amount
-            groups[obj.ticket_name]['items'].append(obj)
-            groups[obj.ticket_name]['count'] = groups[obj.ticket_name]['count'] + obj.total_amount
-
         result = ""
         for group in groups:
-            result += str(group).capitalize() + ": " + str(len(groups[group]['items'])) + " / " + str(
-                groups[group]['count'] / 100) + "р. \n\n"
+            amount = helper.safe_list_get(groups[group], "amount", 0)
+            total = total + amount
+            taxes = taxes + amount
+            result += str(group).capitalize() + ": " + str(helper.safe_list_get(groups[group], "count", 0)) + " / " + \
+                      str(amount / 100) + "р. \n\n"
 
         result += f"Всего: {str(total / 100)}р\n"
         result += f"Через Кирю: {str(round(taxes / 100 * 0.905, 2))} ({str(taxes / 100)})\n"
         result += f"Через тинек: {str((total - taxes) / 100)}р\n"
+        result += f"Активировано: {helper.safe_list_get(stats, 'activated', 0)}\n"
         return result
 
-    @staticmethod
-    def statistics_csv():
-        # csv header
-        fieldnames = ['customer_name', 'email', 'ticket_name', 'ticket_base_price',
+    CSV_FIELDNAMES = ['customer_name', 'email', 'ticket_name', 'ticket_base_price',
                       'total_amount', 'phone_number',
                       'user', 'user_name', 'user_username',
                       'ticket_description', 'id', 'created',
                       'provider_payment_charge_id', 'telegram_payment_charge_id', 'currency',
                       'issuer_username', 'issuer_name', 'issuer', 'activated']
 
-        # csv data
-        rows = [purchase._data for purchase in TicketPurchase.all()]
-
-        with open('purchases.csv', 'w', encoding='UTF8', newline='\n') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
+    @staticmethod
+    def statistics_csv(columns: List[str] = None, date_from: datetime = None, date_to: datetime = None,
+                       compress: bool = False) -> io.BytesIO:
+        exporter = CsvExporter(TicketPurchase.ref(), TicketPurchase.CSV_FIELDNAMES)
+        return exporter.export("purchases", columns=columns, date_from=date_from, date_to=date_to, compress=compress)
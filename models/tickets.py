@@ -1,14 +1,13 @@
-from firebase_admin.db import Reference
-from telegram import TelegramError
-
 from models.base_products import BaseProduct
+from models.fields import Field
 from persistence.firebase_persistence import FirebasePersistence
-from utils import helper
+from persistence.reference import Reference
 
 store = FirebasePersistence()
 
 
 class Ticket(BaseProduct):
+    __slots__ = ()
 
     PAID_TYPE = "paid"
     FREE_TYPE = "free"
@@ -17,13 +16,7 @@ class Ticket(BaseProduct):
     def ref(cls) -> Reference:
         return store.tickets
 
-    @property
-    def increase_step(self):
-        return helper.safe_list_get(self._data, "increase_step", 0)
-
-    @increase_step.setter
-    def increase_step(self, increase_step: int):
-        raise TelegramError("Increase step is being changed only via Firebase store")
+    increase_step = Field(0, readonly="Increase step is being changed only via Firebase store")
 
     # Functions
 
@@ -33,4 +26,4 @@ class Ticket(BaseProduct):
 
     @staticmethod
     def by_type(_type: str):
-        return list(filter(lambda ticket: ticket.type == _type, Ticket.all()))
+        return list(filter(lambda ticket: ticket.type == _type, Ticket.catalog().values()))
@@ -1,20 +1,37 @@
 import collections
+import time
 from datetime import datetime
-from itertools import groupby
+from threading import Lock
+from typing import List, Optional, Tuple
 
 from telegram import TelegramError
 
+from models.fields import Field, Model, TimestampField
+from models.stats import Stats
 from persistence.firebase_persistence import FirebasePersistence
+from persistence.reference import Reference, start_at_key
+from persistence.unit_of_work import UnitOfWork
 from utils import helper
+from utils.identity_map import IdentityMap
 
 store = FirebasePersistence()
 
 
-class User:
+class User(Model):
+    __slots__ = ()
+
     STATUS_WELCOME = 'just_open_bot'
     STATUS_APPROVED = 'approved'
     STATUS_READY = 'ready'
 
+    ROLE_ADMIN = 'admin'
+    ROLE_GOD = 'god'
+    ROLES_CACHE_TTL = 300
+
+    # role -> (expires at, users with the role)
+    _roles = {}
+    _roles_lock = Lock()
+
     @staticmethod
     def status_to_pretty():
         return dict([
@@ -31,112 +48,35 @@ class User:
             (User.STATUS_READY, "Есть билет"),
         ])
 
-    def __init__(self):
-        self._id = None
-        self._data = {}
-        self.status = None
-
-    @property
-    def id(self):
-        return self._id
-
-    @id.setter
-    def id(self, _id: int):
-        self._id = _id
-
-    @property
-    def admin(self):
-        return helper.safe_list_get(self._data, "admin", False)
-
-    @admin.setter
-    def admin(self, admin: bool):
-        raise TelegramError("Нельзя устанавливать пользователя в админа")
-
-    @property
-    def god(self):
-        return helper.safe_list_get(self._data, "god", False)
-
-    @god.setter
-    def god(self, god: bool):
-        raise TelegramError("Нельзя устанавливать пользователя в бога")
+    admin = Field(False, readonly="Нельзя устанавливать пользователя в админа")
+    god = Field(False, readonly="Нельзя устанавливать пользователя в бога")
+    status = Field("")
+    first_name = Field("")
+    last_name = Field("")
+    real_name = Field("")
+    insta = Field("")
+    vk = Field("")
+    purchase_id = Field("")
+    created = TimestampField()
+    created_timestamp = Field(key="created")
 
-    @property
-    def status(self):
-        return helper.safe_list_get(self._data, "status")
-
-    @status.setter
-    def status(self, status: str):
-        self._data["status"] = status
-
-    @property
-    def first_name(self):
-        return helper.safe_list_get(self._data, "first_name")
-
-    @first_name.setter
-    def first_name(self, first_name: str):
-        self._data["first_name"] = first_name
-
-    @property
-    def last_name(self):
-        return helper.safe_list_get(self._data, "last_name")
-
-    @last_name.setter
-    def last_name(self, last_name: str):
-        self._data["last_name"] = last_name
+    @staticmethod
+    def ref() -> Reference:
+        return store.users
 
     @property
     def username(self):
-        return f"@{helper.safe_list_get(self._data, 'username', 'no_username')}"
+        return f"@{self._data.get('username', 'no_username')}"
 
     @username.setter
     def username(self, username: str):
-        self._data["username"] = username
-
-    @property
-    def real_name(self):
-        return helper.safe_list_get(self._data, "real_name")
-
-    @real_name.setter
-    def real_name(self, real_name: str):
-        self._data["real_name"] = real_name
-
-    @property
-    def insta(self):
-        return helper.safe_list_get(self._data, "insta")
-
-    @insta.setter
-    def insta(self, insta: str):
-        self._data["insta"] = insta
-
-    @property
-    def vk(self):
-        return helper.safe_list_get(self._data, "vk")
-
-    @vk.setter
-    def vk(self, vk: str):
-        self._data["vk"] = vk
-
-    @property
-    def purchase_id(self):
-        return helper.safe_list_get(self._data, "purchase_id")
-
-    @purchase_id.setter
-    def purchase_id(self, purchase_id: str):
-        self._data["purchase_id"] = purchase_id
-
-    @property
-    def created(self):
-        timestamp = helper.safe_list_get(self._data, "created")
-        if timestamp:
-            return datetime.fromtimestamp(timestamp).strftime(
-                '%Y-%m-%d %H:%M:%S')
+        self._set("username", username)
 
-    @created.setter
-    def created(self, created: float):
-        self._data["created"] = created
+    def stats_changes(self, old: dict, new: dict) -> dict:
+        return Stats.user_changes(old, new)
 
-    def save(self):
-        store.users.child(str(self._id)).update(self._data)
+    def save(self, uow: UnitOfWork = None):
+        UnitOfWork.save(self, uow)
 
     def full_name(self):
         if self.real_name:
@@ -144,9 +84,6 @@ class User:
 
         return f"{self.first_name} {self.last_name}"
 
-    def tech_data(self):
-        return self._data
-
     # Functions
 
     def set_data(self, data: dict):
@@ -161,11 +98,11 @@ class User:
         if not self._id:
             raise TelegramError(f"Отсутстует id")
 
-        _data = store.users.child(str(self._id)).get()
+        _data = User.ref().child(str(self._id)).get()
         if not _data:
             raise TelegramError(f"Нет данных по пользователю с id: {self._id}")
 
-        self._data = _data
+        self.set_stored(_data)
 
     def pretty_html(self, index: int = None):
         return "<b>{}{}</b> => {}\n" \
@@ -184,53 +121,118 @@ class User:
     def get(_id: int, data=None):
         # if not User.exists(_id):
         #     raise TelegramError(f"Нет пользователя с id {_id}")
+        if not data:
+            return IdentityMap.lookup(User, _id, lambda: User.load_new(_id))
+
         user = User()
         user.id = _id
-        if data:
-            user._data = data
-        else:
-            user.load()
+        user.set_stored(data)
+        return user
 
+    @staticmethod
+    def load_new(_id: int):
+        user = User()
+        user.id = _id
+        user.load()
         return user
 
     @staticmethod
     def exists(_id: int):
-        return bool(store.users.child(str(_id)).get())
+        return bool(User.ref().child(str(_id)).get())
 
     @staticmethod
-    def create_new(_id: int):
-        if User.exists(_id):
-            raise TelegramError(f"Попытка создать пользователя с существующем id {_id}")
-
-        store.users.child(str(_id)).update({
-            'id': _id,
-            'created': datetime.now().timestamp()
-        })
-
-        user = User()
-        user.id = _id
-        user._data = store.users.child(str(_id)).get()
-        return user
+    def create_new(_id: int, data: dict = None):
+        return User.insert(_id, dict(data or {}, id=_id, created=datetime.now().timestamp()),
+                           f"Попытка создать пользователя с существующем id {_id}")
 
     @staticmethod
     def all(sort: str = "created", reverse=False):
-        fb_users = store.users.order_by_child(sort).get() if sort else store.users.get()
+        fb_users = User.ref().order_by_child(sort).get() if sort else User.ref().get()
         fb_users = fb_users if fb_users else []
 
         fb_users = collections.OrderedDict(reversed(list(fb_users.items()))) if reverse else fb_users
         return list(map(lambda fb_user: User.get(fb_user, fb_users[fb_user]), fb_users))
 
+    @staticmethod
+    def page_by_created(cursor: Optional[Tuple[float, str]] = None, limit: int = 10) -> List["User"]:
+        """Users ordered by created and id, starting at the (created, id) cursor."""
+        query = User.ref().order_by_child("created")
+        if cursor is not None:
+            query = query.start_at(cursor[0])
+
+        # One more user than asked for shows the last created value is complete
+        fetch = limit + 1
+        while True:
+            fb_users = query.limit_to_first(fetch).get() or {}
+            rows = sorted(fb_users.items(), key=created_order)
+            if cursor is not None:
+                rows = [row for row in rows if created_order(row) >= created_order(cursor)]
+            # Users created at the same time come in no set order, the page may end only after all of them
+            if len(fb_users) < fetch or \
+                    (len(rows) >= limit and created_order(rows[-1])[0] > created_order(rows[limit - 1])[0]):
+                return [User.get(key, data) for key, data in rows[:limit]]
+            fetch *= 2
+
+    @staticmethod
+    def page_before_created(cursor: Tuple[float, str], limit: int = 10) -> List["User"]:
+        """The last users before the (created, id) cursor, ordered by created and id."""
+        query = User.ref().order_by_child("created").end_at(cursor[0])
+
+        # end_at is inclusive and brings the cursor user back, one more user shows the first created value is complete
+        fetch = limit + 2
+        while True:
+            fb_users = query.limit_to_last(fetch).get() or {}
+            rows = [row for row in sorted(fb_users.items(), key=created_order)
+                    if created_order(row) < created_order(cursor)]
+            if len(fb_users) < fetch or \
+                    (len(rows) >= limit and created_order(rows[0])[0] < created_order(rows[-limit])[0]):
+                return [User.get(key, data) for key, data in rows[-limit:]]
+            fetch *= 2
+
+    @staticmethod
+    def count():
+        return sum(helper.safe_list_get(Stats.get(), "users", {}).values())
+
     @staticmethod
     def gods():
-        return list(filter(lambda user: user.god, User.all()))
+        return User.by_role(User.ROLE_GOD)
 
     @staticmethod
     def admins():
-        return list(filter(lambda user: user.admin, User.all()))
+        return User.by_role(User.ROLE_ADMIN)
+
+    @staticmethod
+    def by_role(role: str):
+        # Roles are granted only via Firebase console, so a short-lived cache is enough
+        cached = User._roles.get(role)
+        if cached and cached[0] > time.monotonic():
+            return list(cached[1])
+
+        with User._roles_lock:
+            fb_users = User.ref().order_by_child(role).equal_to(True).get()
+            fb_users = fb_users if fb_users else {}
+            users = [User.get(fb_user, fb_users[fb_user]) for fb_user in fb_users]
+            User._roles[role] = (time.monotonic() + User.ROLES_CACHE_TTL, users)
+
+        return list(users)
 
     @staticmethod
     def by_status(_status: str):
-        return list(filter(lambda user: user.status == _status, User.all()))
+        fb_users = User.ref().order_by_child("status").equal_to(_status).get()
+        fb_users = fb_users if fb_users else {}
+        return [User.get(fb_user, fb_users[fb_user]) for fb_user in fb_users]
+
+    @staticmethod
+    def page_by_status(_status: str, start_after: str = None, limit: int = 100) -> List["User"]:
+        """Users with the status in key order, after the start_after key."""
+        query = User.ref().order_by_child("status")
+        if start_after is None:
+            fb_users = query.equal_to(_status).limit_to_first(limit).get() or {}
+        else:
+            # start_at is inclusive, so fetch one more and drop the cursor itself
+            fb_users = start_at_key(query, _status, str(start_after)).end_at(_status).limit_to_first(limit + 1).get()
+            fb_users = fb_users if fb_users else {}
+        return [User.get(fb_user, fb_users[fb_user]) for fb_user in fb_users if fb_user != str(start_after)][:limit]
 
     @staticmethod
     def group_by_status():
@@ -241,9 +243,20 @@ class User:
 
     @staticmethod
     def statistics():
-        groups = User.group_by_status()
+        counts = helper.safe_list_get(Stats.get(), "users", {})
         result = ""
-        for group in groups:
-            result += User.status_to_pretty()[group].capitalize() + ": " + str(len(groups[group])) + "\n"
+        for status, pretty in User.status_to_pretty().items():
+            if helper.safe_list_get(counts, status, 0):
+                result += pretty.capitalize() + ": " + str(counts[status]) + "\n"
 
         return result
+
+
+def created_order(row: tuple) -> tuple:
+    """Sort key of a (key, data) row or a (created, key) cursor, keys ordered as Firebase orders them."""
+    if isinstance(row[1], dict):
+        row = (helper.safe_list_get(row[1], "created", None) or 0, row[0])
+    created, key = row
+    key = str(key)
+    # Keys that are integers come first in numeric order
+    return (created, 0, int(key), "") if key.lstrip("-").isdigit() else (created, 1, 0, key)
@@ -1,13 +1,40 @@
-import firebase_admin
-from firebase_admin import db
 from telegram.ext import BasePersistence
 from ast import literal_eval
 from collections import defaultdict
-from typing import Dict
+from threading import Lock
+from typing import Callable, Dict, Hashable, Optional
 from settings import Settings
 
-cred = firebase_admin.credentials.Certificate(Settings.fb_creds())
-firebase_admin.initialize_app(cred, {"databaseURL": Settings.db_url()})
+
+def connect() -> Callable:
+    """Returns the reference factory of the configured storage backend."""
+    if Settings.storage_backend() == Settings.STORAGE_SQLITE:
+        from persistence.sqlite_storage import SqliteStorage
+        return SqliteStorage(Settings.sqlite_path()).reference
+
+    import firebase_admin
+    from firebase_admin import db
+    cred = firebase_admin.credentials.Certificate(Settings.fb_creds())
+    firebase_admin.initialize_app(cred, {"databaseURL": Settings.db_url()})
+    return db.reference
+
+
+_reference: Optional[Callable] = None
+
+
+def configure(reference_factory: Callable):
+    """Uses the given reference factory instead of the configured backend, call it before any model is used."""
+    global _reference
+    if _reference is not None:
+        raise RuntimeError("Storage is already connected, configure it before the first database access")
+    _reference = reference_factory
+
+
+def reference(path: str = "/"):
+    global _reference
+    if _reference is None:
+        _reference = connect()
+    return _reference(path)
 
 
 class FirebasePersistence(BasePersistence):
@@ -18,18 +45,30 @@ class FirebasePersistence(BasePersistence):
         return cls.instance
 
     def __init__(self):
+        # __new__ returns the shared instance, so __init__ runs on every FirebasePersistence() call
+        if hasattr(self, "_conversations"):
+            return
+
         # cred = firebase_admin.credentials.Certificate(credentials)
         # self.app = app
-        self.fb_user_data = db.reference("user_data")
-        self.users = db.reference("users")
-
-        self.purchases = db.reference("ticket_purchases")
-        self.tickets = db.reference("tickets")
-
-        self.settings = db.reference("settings")
-        self.fb_chat_data = db.reference("chat_data")
-        self.fb_bot_data = db.reference("bot_data")
-        self.fb_conversations = db.reference("conversations")
+        self.root = reference()
+        self.fb_user_data = reference("user_data")
+        self.users = reference("users")
+
+        self.purchases = reference("ticket_purchases")
+        self.tickets = reference("tickets")
+
+        self.settings = reference("settings")
+        self.broadcasts = reference("broadcasts")
+        self.stats = reference("stats")
+        self.fb_chat_data = reference("chat_data")
+        self.fb_bot_data = reference("bot_data")
+        self.fb_conversations = reference("conversations")
+
+        # Write-through cache of conversation states: name -> {key tuple: state}. The ConversationHandler
+        # with the name gets the dict itself as its conversations, so both always see the same states
+        self._conversations = {}
+        self._conversations_lock = Lock()
         super().__init__(
             store_user_data=False,
             store_chat_data=False,
@@ -50,15 +89,53 @@ class FirebasePersistence(BasePersistence):
         return defaultdict(dict, self.fb_bot_data.get() or {})
 
     def get_conversations(self, name):
-        res = self.fb_conversations.child(name).get() or {}
-        res = {literal_eval(k): v for k, v in res.items()}
-        return res
+        return self._conversation_cache(name)
+
+    def get_conversation(self, name, key: Hashable) -> Optional[int]:
+        state = self._conversation_cache(name).get(key)
+        while isinstance(state, tuple):
+            state = state[0]
+        return state
+
+    def update_conversation(self, name, key, new_state, uow=None):
+        # A run_async handler is still running: (old state, Promise), possibly nested. The handler keeps
+        # the tuple in the shared dict to pick up the result later, only the old state is stored
+        pending = isinstance(new_state, tuple)
+        while isinstance(new_state, tuple):
+            new_state = new_state[0]
+
+        ref = self.fb_conversations.child(name).child(str(key))
+        if uow:
+            # Written with the rest of the unit of work, the cache follows once it is committed
+            uow.add({ref.path.strip("/"): new_state or None})
+            if not pending:
+                uow.after_commit(lambda: self._cache_conversation(name, key, new_state))
+            return
+
+        if new_state:
+            ref.set(new_state)
+        else:
+            ref.delete()
+        if not pending:
+            self._cache_conversation(name, key, new_state)
 
-    def update_conversation(self, name, key, new_state):
+    def _cache_conversation(self, name, key, new_state):
+        cache = self._conversation_cache(name)
         if new_state:
-            self.fb_conversations.child(name).child(str(key)).set(new_state)
+            cache[key] = new_state
         else:
-            self.fb_conversations.child(name).child(str(key)).delete()
+            cache.pop(key, None)
+
+    def _conversation_cache(self, name) -> Dict:
+        cache = self._conversations.get(name)
+        if cache is not None:
+            return cache
+
+        with self._conversations_lock:
+            if name not in self._conversations:
+                res = self.fb_conversations.child(name).get() or {}
+                self._conversations[name] = {literal_eval(k): v for k, v in res.items()}
+            return self._conversations[name]
 
     def update_user_data(self, user_id, data):
         self.fb_user_data.child(str(user_id)).update(data)
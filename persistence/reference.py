@@ -0,0 +1,55 @@
+import json
+from typing import Any, Callable, Optional, Protocol
+
+
+class Query(Protocol):
+    def start_at(self, start) -> "Query": ...
+
+    def end_at(self, end) -> "Query": ...
+
+    def equal_to(self, value) -> "Query": ...
+
+    def limit_to_first(self, limit: int) -> "Query": ...
+
+    def limit_to_last(self, limit: int) -> "Query": ...
+
+    def get(self) -> Any: ...
+
+
+class Reference(Protocol):
+    """The part of firebase_admin.db.Reference the models use, implemented by every storage backend."""
+
+    @property
+    def key(self) -> Optional[str]: ...
+
+    @property
+    def path(self) -> str: ...
+
+    def child(self, path: str) -> "Reference": ...
+
+    def get(self) -> Any: ...
+
+    def set(self, value): ...
+
+    def update(self, value: dict): ...
+
+    def delete(self): ...
+
+    def push(self, value=None) -> "Reference": ...
+
+    def transaction(self, transaction_update: Callable) -> Any: ...
+
+    def listen(self, callback: Callable): ...
+
+    def order_by_child(self, path: str) -> Query: ...
+
+    def order_by_key(self) -> Query: ...
+
+
+def start_at_key(query: Query, value, key: str) -> Query:
+    """Starts at the child value and, among children with that value, at the key: startAt(value, key) of the
+    Firebase client SDKs. firebase_admin has no key argument, so its REST parameter is set directly."""
+    if hasattr(query, "_params"):
+        query._params["startAt"] = f"{json.dumps(value)},{json.dumps(key)}"
+        return query
+    return query.start_at(value, key)
@@ -0,0 +1,289 @@
+import collections
+import json
+import os
+import re
+import sqlite3
+import time
+from threading import RLock
+from typing import Callable, List, Optional
+
+# Children of these fields are queried with order_by_child, so they get real indexes
+INDEXED_FIELDS = ("user", "status", "created", "ticket_name", "admin", "god")
+
+
+class SqliteStorage:
+    """Local database with the Firebase Realtime Database tree model.
+
+    Top-level nodes are collections, their children are rows holding JSON. Paths below a
+    row are resolved inside its JSON document.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = RLock()
+        self._depth = 0
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS nodes ("
+            "collection TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (collection, key)) WITHOUT ROWID")
+        for field in INDEXED_FIELDS:
+            self._connection.execute(
+                f"CREATE INDEX IF NOT EXISTS nodes_{field} ON nodes (collection, json_extract(value, '$.{field}'))")
+
+    def reference(self, path: str = "/") -> "SqliteReference":
+        return SqliteReference(self, split_path(path))
+
+    # Row access, callers hold the lock
+
+    def read_row(self, collection: str, key: str):
+        row = self._connection.execute(
+            "SELECT value FROM nodes WHERE collection = ? AND key = ?", (collection, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_row(self, collection: str, key: str, value):
+        if is_empty(value):
+            self._connection.execute("DELETE FROM nodes WHERE collection = ? AND key = ?", (collection, key))
+        else:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO nodes (collection, key, value) VALUES (?, ?, ?)",
+                (collection, key, json.dumps(value, ensure_ascii=False)))
+
+    def read_collection(self, collection: str, where: str = "", params: tuple = (), order: str = "key",
+                        limit: int = None, descending: bool = False) -> collections.OrderedDict:
+        sql = f"SELECT key, value FROM nodes WHERE collection = ? {where} " \
+              f"ORDER BY {order} {'DESC' if descending else ''}, key {'DESC' if descending else ''}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        rows = self._connection.execute(sql, (collection,) + params).fetchall()
+        if descending:
+            rows.reverse()
+        return collections.OrderedDict((key, json.loads(value)) for key, value in rows)
+
+    def delete_collection(self, collection: str):
+        self._connection.execute("DELETE FROM nodes WHERE collection = ?", (collection,))
+
+    def collections(self) -> List[str]:
+        return [row[0] for row in self._connection.execute("SELECT DISTINCT collection FROM nodes")]
+
+    def atomic(self, operation: Callable):
+        with self._lock:
+            # A transaction callback may write through other references, only the outermost call commits
+            if self._depth:
+                return operation()
+
+            self._depth += 1
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = operation()
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            else:
+                self._connection.execute("COMMIT")
+            finally:
+                self._depth -= 1
+            return result
+
+
+class SqliteReference:
+    """The part of firebase_admin.db.Reference the bot uses, see persistence.reference."""
+
+    def __init__(self, storage: SqliteStorage, parts: List[str]):
+        self._storage = storage
+        self._parts = parts
+
+    @property
+    def key(self) -> Optional[str]:
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self) -> str:
+        return "/" + "/".join(self._parts)
+
+    def child(self, path: str) -> "SqliteReference":
+        return SqliteReference(self._storage, self._parts + split_path(path))
+
+    def get(self):
+        with self._storage._lock:
+            return self._get()
+
+    def set(self, value):
+        self._storage.atomic(lambda: self._set(self._parts, value))
+
+    def update(self, value: dict):
+        if not value or not isinstance(value, dict):
+            raise ValueError("Value argument must be a non-empty dictionary.")
+
+        def write():
+            for path, item in value.items():
+                self._set(self._parts + split_path(path), item)
+
+        self._storage.atomic(write)
+
+    def delete(self):
+        self._storage.atomic(lambda: self._set(self._parts, None))
+
+    def push(self, value=None) -> "SqliteReference":
+        # Time ordered like Firebase push ids
+        ref = self.child(f"{time.time_ns():x}{os.urandom(4).hex()}")
+        if value is not None:
+            ref.set(value)
+        return ref
+
+    def transaction(self, transaction_update: Callable):
+        def run():
+            value = transaction_update(self._get())
+            self._set(self._parts, value)
+            return value
+
+        return self._storage.atomic(run)
+
+    def listen(self, callback):
+        # Nothing else writes to a local database, there are no remote changes to follow
+        return None
+
+    def order_by_child(self, path: str) -> "SqliteQuery":
+        if not re.fullmatch(r"[A-Za-z0-9_]+", path):
+            raise ValueError(f"Unsupported child path {path}")
+        return SqliteQuery(self, path)
+
+    def order_by_key(self) -> "SqliteQuery":
+        return SqliteQuery(self, None)
+
+    # Internals, the storage lock is held
+
+    def _get(self):
+        storage = self._storage
+        if not self._parts:
+            root = {collection: storage.read_collection(collection) for collection in storage.collections()}
+            return root or None
+        if len(self._parts) == 1:
+            return storage.read_collection(self._parts[0]) or None
+
+        value = storage.read_row(self._parts[0], self._parts[1])
+        for part in self._parts[2:]:
+            if not isinstance(value, dict) or part not in value:
+                return None
+            value = value[part]
+        return value
+
+    def _set(self, parts: List[str], value):
+        storage = self._storage
+        if not parts:
+            for collection in storage.collections():
+                storage.delete_collection(collection)
+            for collection, item in (value or {}).items():
+                self._set([collection], item)
+            return
+
+        if len(parts) == 1:
+            current = storage.read_collection(parts[0])
+            storage.delete_collection(parts[0])
+            for key, item in (resolve_server_values(value, current) or {}).items():
+                storage.write_row(parts[0], key, item)
+            return
+
+        collection, key, path = parts[0], parts[1], parts[2:]
+        row = storage.read_row(collection, key)
+        if not path:
+            storage.write_row(collection, key, resolve_server_values(value, row))
+            return
+
+        row = row if isinstance(row, dict) else {}
+        node = row
+        for part in path[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        node[path[-1]] = resolve_server_values(value, node.get(path[-1]))
+        storage.write_row(collection, key, prune(row))
+
+
+class SqliteQuery:
+
+    def __init__(self, ref: SqliteReference, child: Optional[str]):
+        self._ref = ref
+        self._child = child
+        self._start = None
+        self._start_key = None
+        self._end = None
+        self._first = None
+        self._last = None
+
+    def start_at(self, value, key: str = None):
+        self._start = value
+        self._start_key = key
+        return self
+
+    def end_at(self, value):
+        self._end = value
+        return self
+
+    def equal_to(self, value):
+        self._start = self._end = value
+        return self
+
+    def limit_to_first(self, limit: int):
+        self._first = limit
+        return self
+
+    def limit_to_last(self, limit: int):
+        self._last = limit
+        return self
+
+    def get(self) -> collections.OrderedDict:
+        parts = self._ref._parts
+        if len(parts) != 1:
+            raise ValueError(f"Queries are supported on top-level nodes only, got {self._ref.path}")
+
+        order = "key" if self._child is None else f"json_extract(value, '$.{self._child}')"
+        where = ""
+        params = ()
+        if self._start is not None and self._start_key is not None:
+            # Children with the start value continue from the key, in the key order of read_collection
+            where += f" AND ({order} > ? OR ({order} = ? AND key >= ?))"
+            params += (self._start, self._start, self._start_key)
+        elif self._start is not None:
+            where += f" AND {order} >= ?"
+            params += (self._start,)
+        if self._end is not None:
+            where += f" AND {order} <= ?"
+            params += (self._end,)
+
+        storage = self._ref._storage
+        with storage._lock:
+            if self._last is not None:
+                return storage.read_collection(parts[0], where, params, order, self._last, descending=True)
+            return storage.read_collection(parts[0], where, params, order, self._first)
+
+
+def split_path(path: str) -> List[str]:
+    return [part for part in str(path).split("/") if part]
+
+
+def is_empty(value) -> bool:
+    return value is None or value == {} or value == []
+
+
+def prune(value):
+    # Firebase does not keep empty nodes
+    if isinstance(value, dict):
+        value = {key: prune(item) for key, item in value.items()}
+        return {key: item for key, item in value.items() if not is_empty(item)}
+    return value
+
+
+def resolve_server_values(value, current):
+    if isinstance(value, dict):
+        server_value = value.get(".sv")
+        if isinstance(server_value, dict) and "increment" in server_value:
+            base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+            return base + server_value["increment"]
+
+        current = current if isinstance(current, dict) else {}
+        return prune({key: resolve_server_values(item, current.get(key)) for key, item in value.items()})
+    return value
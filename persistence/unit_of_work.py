@@ -0,0 +1,70 @@
+from typing import Callable, List
+
+from persistence.firebase_persistence import FirebasePersistence
+
+store = FirebasePersistence()
+
+
+class UnitOfWork:
+    """Collects model and path changes and commits them as one multi-path update at the database root."""
+
+    def __init__(self):
+        self._models = []
+        self._changes = {}
+        self._callbacks: List[Callable] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+    def register(self, model):
+        # Changes are collected at commit, so saving a model twice costs nothing extra
+        if not any(registered is model for registered in self._models):
+            self._models.append(model)
+
+    def add(self, changes: dict):
+        merge_changes(self._changes, changes)
+
+    def after_commit(self, callback: Callable):
+        self._callbacks.append(callback)
+
+    def commit(self):
+        changes = dict(self._changes)
+        for model in self._models:
+            merge_changes(changes, model.changes())
+
+        if changes:
+            store.root.update(changes)
+
+        for model in self._models:
+            model.mark_stored()
+        for callback in self._callbacks:
+            callback()
+
+        self._models = []
+        self._changes = {}
+        self._callbacks = []
+
+    @staticmethod
+    def save(model, uow: "UnitOfWork" = None):
+        if uow:
+            uow.register(model)
+            return
+
+        with UnitOfWork() as uow:
+            uow.register(model)
+
+
+def merge_changes(changes: dict, new: dict):
+    for path, value in new.items():
+        current = changes.get(path)
+        if is_increment(current) and is_increment(value):
+            value = {".sv": {"increment": current[".sv"]["increment"] + value[".sv"]["increment"]}}
+        changes[path] = value
+
+
+def is_increment(value) -> bool:
+    return isinstance(value, dict) and isinstance(value.get(".sv"), dict) and "increment" in value[".sv"]
@@ -1,33 +1,123 @@
 import os
 import json
+import time
+from threading import Lock
 from utils import helper
 
 
 class Settings:
 
     IS_TEST = False
+    CACHE_TTL = 60
+
+    STORAGE_FIREBASE = "firebase"
+    STORAGE_SQLITE = "sqlite"
+
+    MODE_POLLING = "polling"
+    MODE_WEBHOOK = "webhook"
+
+    _cache = None
+    _cache_expires = 0.0
+    _cache_lock = Lock()
+    _creds = {}
+    _listener = None
 
     @staticmethod
     def max_invites():
-        from persistence.firebase_persistence import FirebasePersistence
-        settings = FirebasePersistence().settings.get()
-        return helper.safe_list_get(settings, "max_invites", 5)
+        return Settings.get("max_invites", 5)
 
     @staticmethod
     def enable_merch():
+        return Settings.get("enable_merch", False)
+
+    @staticmethod
+    def offline_checkin():
+        return Settings.get("offline_checkin", False)
+
+    @staticmethod
+    def get(key: str, default=None):
+        return helper.safe_list_get(Settings._settings(), key, default)
+
+    @staticmethod
+    def invalidate():
+        Settings._cache_expires = 0.0
+
+    @staticmethod
+    def watch():
+        # Firebase pushes every change of the settings node, so the TTL becomes only a safety net
         from persistence.firebase_persistence import FirebasePersistence
-        settings = FirebasePersistence().settings.get()
-        return helper.safe_list_get(settings, "enable_merch", False)
+        if not Settings._listener:
+            Settings._listener = FirebasePersistence().settings.listen(lambda event: Settings.invalidate())
+
+    @staticmethod
+    def _settings() -> dict:
+        if Settings._cache_expires < time.monotonic():
+            with Settings._cache_lock:
+                if Settings._cache_expires < time.monotonic():
+                    from persistence.firebase_persistence import FirebasePersistence
+                    Settings._cache = FirebasePersistence().settings.get() or {}
+                    Settings._cache_expires = time.monotonic() + Settings.CACHE_TTL
+        return Settings._cache
 
     @staticmethod
     def fb_creds():
-        with open(f"FB_CREDS{'_TEST' if Settings.IS_TEST else ''}.json") as file:
-            return json.load(file)
+        if Settings.IS_TEST not in Settings._creds:
+            with open(f"FB_CREDS{'_TEST' if Settings.IS_TEST else ''}.json") as file:
+                Settings._creds[Settings.IS_TEST] = json.load(file)
+        return Settings._creds[Settings.IS_TEST]
 
     @staticmethod
     def db_url():
         return os.environ[f"FB_DB_URL{'_TEST' if Settings.IS_TEST else ''}"]
 
+    @staticmethod
+    def storage_backend():
+        return os.environ.get("STORAGE_BACKEND", Settings.STORAGE_FIREBASE)
+
+    @staticmethod
+    def sqlite_path():
+        return os.environ.get("SQLITE_PATH", "dmm.sqlite3")
+
+    @staticmethod
+    def bot_mode():
+        return os.environ.get("BOT_MODE", Settings.MODE_POLLING)
+
+    @staticmethod
+    def bot_workers() -> int:
+        return int(os.environ.get("BOT_WORKERS", 4))
+
+    @staticmethod
+    def update_queue_size() -> int:
+        return int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+
+    @staticmethod
+    def bot_api_url():
+        return os.environ.get("BOT_API_URL", "https://api.telegram.org")
+
+    @staticmethod
+    def webhook_url():
+        return os.environ["WEBHOOK_URL"]
+
+    @staticmethod
+    def webhook_path():
+        return os.environ.get("WEBHOOK_PATH", "telegram")
+
+    @staticmethod
+    def webhook_listen():
+        return os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+
+    @staticmethod
+    def webhook_port() -> int:
+        return int(os.environ.get("WEBHOOK_PORT", 8443))
+
+    @staticmethod
+    def metrics_path():
+        return os.environ.get("METRICS_PATH", "metrics.prom")
+
+    @staticmethod
+    def checkin_journal_path():
+        return os.environ.get("CHECKIN_JOURNAL_PATH", "checkin_journal.jsonl")
+
     @staticmethod
     def bot_token():
         return os.environ[f"BOT_TOKEN{'_TEST' if Settings.IS_TEST else ''}"]
@@ -0,0 +1,72 @@
+import csv
+import gzip
+import io
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from persistence.reference import Reference, start_at_key
+
+
+class CsvExporter:
+    """Streams a Firebase node into an in-memory CSV, reading it in pages ordered by key or by a date child."""
+
+    def __init__(self, ref: Reference, fieldnames: List[str], page_size: int = 500):
+        self.ref = ref
+        self.fieldnames = fieldnames
+        self.page_size = page_size
+
+    def rows(self, date_field: str = None, since: float = None, until: float = None) -> Iterator[dict]:
+        """All rows in key order, or with date_field the rows from since to until, inclusive, in its order."""
+        last = None
+        while True:
+            query = self.ref.order_by_child(date_field) if date_field else self.ref.order_by_key()
+            limit = self.page_size
+            if last:
+                # start_at is inclusive, the cursor row is fetched again and skipped
+                query = start_at_key(query, *last) if date_field else query.start_at(last[1])
+                limit += 1
+            elif since is not None:
+                query = query.start_at(since)
+            if until is not None:
+                query = query.end_at(until)
+
+            page = query.limit_to_first(limit).get() or {}
+            for key, row in page.items():
+                if not last or key != last[1]:
+                    yield row
+
+            if len(page) < limit:
+                return
+            last_key = next(reversed(page))
+            last = (page[last_key].get(date_field) if date_field else None, last_key)
+
+    def export(self, name: str, columns: List[str] = None, date_from: Optional[datetime] = None,
+               date_to: Optional[datetime] = None, date_field: str = "created", compress: bool = False) -> io.BytesIO:
+        unknown = [column for column in columns or [] if column not in self.fieldnames]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+        columns = columns or self.fieldnames
+        since = date_from.timestamp() if date_from else None
+        until = date_to.timestamp() if date_to else None
+
+        buffer = io.BytesIO()
+        raw = gzip.GzipFile(fileobj=buffer, mode="wb") if compress else buffer
+        text = io.TextIOWrapper(raw, encoding="UTF8", newline="")
+
+        writer = csv.DictWriter(text, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        # A date range is read through the date_field index, its end is exclusive
+        rows = self.rows(date_field, since, until) if since or until else self.rows()
+        for row in rows:
+            if until and (row.get(date_field) or 0) >= until:
+                continue
+            writer.writerow(row)
+
+        text.flush()
+        text.detach()
+        if compress:
+            raw.close()
+
+        buffer.name = f"{name}.csv.gz" if compress else f"{name}.csv"
+        buffer.seek(0)
+        return buffer
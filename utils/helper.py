@@ -22,3 +22,8 @@ def get_vk(text):
             return "https://vk.com/" + pattern_username.search(text).group(2)
         except AttributeError:
             return False
+
+
+def increment(delta):
+    # Firebase server value, applied atomically by the database within the same write
+    return {".sv": {"increment": delta}}
@@ -0,0 +1,73 @@
+import threading
+from typing import Callable, Optional
+
+_local = threading.local()
+_totals_lock = threading.Lock()
+_totals = {"updates": 0, "hits": 0, "misses": 0}
+
+
+class IdentityMap:
+    """Models loaded while one update is handled, each (class, id) is read from the database at most once."""
+
+    def __init__(self, owner=None):
+        # The update this map belongs to, error handlers of the same update reuse it
+        self.owner = owner
+        self.hits = 0
+        self.misses = 0
+        self._models = {}
+
+    def get(self, cls, _id, load: Callable):
+        key = (cls, str(_id))
+        model = self._models.get(key)
+        if model is not None:
+            self.hits += 1
+            return model
+
+        self.misses += 1
+        model = load()
+        self._models[key] = model
+        return model
+
+    # Binding to the thread that runs the handlers
+
+    @staticmethod
+    def current() -> Optional["IdentityMap"]:
+        return getattr(_local, "identity_map", None)
+
+    @staticmethod
+    def bind(owner) -> "IdentityMap":
+        identity_map = IdentityMap.current()
+        if identity_map is not None and identity_map.owner is owner:
+            return identity_map
+
+        IdentityMap.release()
+        identity_map = IdentityMap(owner)
+        _local.identity_map = identity_map
+        return identity_map
+
+    @staticmethod
+    def release():
+        identity_map = IdentityMap.current()
+        if identity_map is None:
+            return
+
+        _local.identity_map = None
+        with _totals_lock:
+            _totals["updates"] += 1
+            _totals["hits"] += identity_map.hits
+            _totals["misses"] += identity_map.misses
+
+    @staticmethod
+    def lookup(cls, _id, load: Callable):
+        identity_map = IdentityMap.current()
+        if identity_map is None:
+            return load()
+        return identity_map.get(cls, _id, load)
+
+    @staticmethod
+    def statistics() -> str:
+        with _totals_lock:
+            updates, hits, misses = _totals["updates"], _totals["hits"], _totals["misses"]
+        per_update = round(misses / updates, 2) if updates else 0
+        return f"Чтения моделей: {misses} из базы, {hits} из кэша запроса ({updates} апдейтов, " \
+               f"{per_update} чтений на апдейт)"
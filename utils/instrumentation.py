@@ -0,0 +1,244 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from telegram.ext import ConversationHandler, Dispatcher, Handler
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Storage calls made outside of handler callbacks: conversation persistence, delivery workers, broadcasts,
+# settings and catalog reloads
+BACKGROUND = "background"
+
+REFERENCE_OPERATIONS = ("get", "set", "update", "delete", "push", "transaction")
+QUERY_OPERATIONS = ("get",)
+
+# Payloads are serialized again only to count their bytes, so only every Nth call of an operation is measured
+# and counted N times
+PAYLOAD_SAMPLE_EVERY = 10
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Instrumentation:
+    """Latency histograms of handler callbacks and storage calls, with storage calls attributed to the handler."""
+
+    def __init__(self):
+        self.handlers: Dict[str, Histogram] = defaultdict(Histogram)
+        self.errors: Dict[str, int] = defaultdict(int)
+        # (handler, operation) -> latency and transferred JSON bytes, estimated from a sample of the calls
+        self.storage: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.storage_bytes: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._patched = set()
+        self._dumper: Optional[threading.Thread] = None
+        # Callables returning extra Prometheus lines, for components that keep their own counters
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    # Handlers
+
+    def instrument(self, dispatcher: Dispatcher):
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                self._wrap_handler(handler)
+
+        dispatcher.error_handlers = {self.wrap(callback): run_async
+                                     for callback, run_async in dispatcher.error_handlers.items()}
+
+    def wrap(self, callback: Callable, name: str = None) -> Callable:
+        name = name or callback.__name__
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            # Handlers may call each other (rebuild_stats shows stats), the outermost one owns the storage calls
+            outer = getattr(self._local, "handler", None)
+            self._local.handler = outer or name
+            started = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.errors[name] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                self._local.handler = outer
+                with self._lock:
+                    self.handlers[name].observe(elapsed)
+
+        wrapper.instrumented = True
+        return wrapper
+
+    def _wrap_handler(self, handler: Handler):
+        if isinstance(handler, ConversationHandler):
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            for nested_handler in nested:
+                self._wrap_handler(nested_handler)
+            return
+
+        if not getattr(handler.callback, "instrumented", False):
+            handler.callback = self.wrap(handler.callback)
+
+    # Storage
+
+    def instrument_storage(self, reference_class: type, query_class: type):
+        self._patch(reference_class, REFERENCE_OPERATIONS, "")
+        self._patch(query_class, QUERY_OPERATIONS, "query_")
+
+    def _patch(self, cls: type, operations: Iterable[str], prefix: str):
+        if cls in self._patched:
+            return
+        self._patched.add(cls)
+
+        for operation in operations:
+            setattr(cls, operation, self._storage_call(prefix + operation, getattr(cls, operation)))
+
+    def _storage_call(self, operation: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(ref, *args, **kwargs):
+            started = time.perf_counter()
+            result = method(ref, *args, **kwargs)
+            elapsed = time.perf_counter() - started
+
+            key = (getattr(self._local, "handler", None) or BACKGROUND, operation)
+            with self._lock:
+                self.storage[key].observe(elapsed)
+                sampled = (self.storage[key].count - 1) % PAYLOAD_SAMPLE_EVERY == 0
+            if sampled:
+                # Writes send their argument, reads and transactions bring back the result
+                payload = args[0] if args and operation in ("set", "update", "push") else result
+                if hasattr(payload, "path"):
+                    payload = None
+                size = payload_size(payload) * PAYLOAD_SAMPLE_EVERY
+                with self._lock:
+                    self.storage_bytes[key] += size
+            return result
+
+        return wrapper
+
+    def add_collector(self, collector: Callable[[], List[str]]):
+        self._collectors.append(collector)
+
+    # Reports
+
+    def summary(self, limit: int = 15) -> str:
+        with self._lock:
+            handlers = sorted(self.handlers.items(), key=lambda item: item[1].sum, reverse=True)[:limit]
+            calls = defaultdict(int)
+            size = defaultdict(int)
+            for (handler, operation), histogram in self.storage.items():
+                calls[handler] += histogram.count
+                size[handler] += self.storage_bytes[(handler, operation)]
+
+            lines = []
+            for name, histogram in handlers:
+                lines.append(f"{name}: {histogram.count} раз, ср. {round(histogram.sum / histogram.count * 1000)} мс, "
+                             f"p95 ≤ {round(histogram.quantile(0.95) * 1000)} мс, "
+                             f"{round(calls[name] / histogram.count, 1)} запр. к базе, "
+                             f"{round(size[name] / histogram.count / 1024, 1)} КБ"
+                             + (f", ошибок {self.errors[name]}" if self.errors[name] else ""))
+            if calls[BACKGROUND]:
+                lines.append(f"{BACKGROUND}: {calls[BACKGROUND]} запр. к базе, {round(size[BACKGROUND] / 1024)} КБ")
+        return "\n".join(lines) if lines else "Пока ничего не измерено"
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines += render_histogram("dmm_handler_seconds", "Handler callback latency",
+                                      {(("handler", name),): histogram for name, histogram in self.handlers.items()})
+            lines += ["# HELP dmm_handler_errors_total Handler callbacks that raised",
+                      "# TYPE dmm_handler_errors_total counter"]
+            lines += [f'dmm_handler_errors_total{{handler="{name}"}} {count}' for name, count in self.errors.items()]
+            lines += render_histogram("dmm_storage_seconds", "Database call latency by handler and operation",
+                                      {(("handler", handler), ("operation", operation)): histogram
+                                       for (handler, operation), histogram in self.storage.items()})
+            lines += ["# HELP dmm_storage_bytes_total JSON bytes sent or received by database calls, sampled",
+                      "# TYPE dmm_storage_bytes_total counter"]
+            lines += [f'dmm_storage_bytes_total{{handler="{handler}",operation="{operation}"}} {size}'
+                      for (handler, operation), size in self.storage_bytes.items()]
+        for collector in self._collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            file.write(self.render())
+        # Scrapers and node_exporter's textfile collector never see a half-written file
+        os.replace(temporary, path)
+
+    def start_dumping(self, path: str, interval: float):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError:
+                    logger.exception(f"Could not write metrics to {path}")
+
+        if not self._dumper:
+            self._dumper = threading.Thread(target=run, name="metrics_dump", daemon=True)
+            self._dumper.start()
+
+
+def render_histogram(name: str, help_text: str, histograms: Dict[tuple, Histogram]) -> list:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, histogram in histograms.items():
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+    return lines
+
+
+def payload_size(value) -> int:
+    if value is None:
+        return 0
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str).encode("UTF8"))
+    except (TypeError, ValueError):
+        return 0
+
+
+metrics = Instrumentation()
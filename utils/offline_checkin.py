@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+from datetime import datetime
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from utils import helper
+
+logger = logging.getLogger(__name__)
+
+# Stores {purchase id: activation time} and returns the ones activated elsewhere with their stored time
+StoreActivations = Callable[[Dict[str, float]], Dict[str, float]]
+
+
+class CheckinEntry(NamedTuple):
+    activated: Optional[float]
+    user_name: str
+    ticket_name: str
+
+    def pretty_html(self):
+        activated = datetime.fromtimestamp(self.activated).strftime('%Y-%m-%d %H:%M:%S') + " UTC" \
+            if self.activated else 'нет'
+        return f"Владелец билета: {self.user_name}\n" \
+               f"Сам билет: {self.ticket_name}\n" \
+               f"Активирован: {activated}"
+
+
+class Conflict(NamedTuple):
+    purchase_id: str
+    activated: float
+    stored: float
+
+
+class OfflineCheckin:
+    """Check-in against a local index of purchases, with activations journaled to disk and synced in batches.
+
+    Scans are validated in memory without a database round trip. Every activation is appended to a JSON
+    lines journal before it is confirmed, a background thread stores them in batches and drops them from
+    the journal once stored. A ticket that turns out to be activated elsewhere in the meantime is a conflict:
+    the stored time wins and the conflict is reported.
+    """
+
+    def __init__(self, path: str, batch_size: int = 50, interval: float = 5.0, backoff: float = 30.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.backoff = backoff
+        self.synced = 0
+        self.conflicts: List[Conflict] = []
+        self._index: Optional[Dict[str, CheckinEntry]] = None
+        self._admins = frozenset()
+        self._lock = Lock()
+        self._store: Optional[StoreActivations] = None
+        self._on_conflict: Optional[Callable[[Conflict], None]] = None
+        self._thread: Optional[Thread] = None
+        self._stopped = Event()
+        # Activations from before a restart that were not stored yet
+        self._pending: List[dict] = self._read_journal()
+
+    @property
+    def loaded(self) -> bool:
+        return self._index is not None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def load(self, purchases: dict, admins: Iterable[int]):
+        """Builds the index from raw purchase records, activations not synced yet are applied on top."""
+        index = {_id: entry(data) for _id, data in purchases.items() if data}
+        with self._lock:
+            for activation in self._pending:
+                current = index.get(activation["id"])
+                if current and not current.activated:
+                    index[activation["id"]] = current._replace(activated=activation["activated"])
+            self._index = index
+            # Ids come as database keys, that is as strings
+            self._admins = frozenset(str(admin) for admin in admins)
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._admins = frozenset()
+
+    def is_admin(self, user_id: int) -> bool:
+        return str(user_id) in self._admins
+
+    def known(self, purchase_id: str) -> bool:
+        return purchase_id in (self._index or {})
+
+    def add(self, purchase_id: str, data: dict):
+        """Adds a purchase made after the index was loaded."""
+        with self._lock:
+            if self._index is not None and purchase_id not in self._index:
+                self._index[purchase_id] = entry(data)
+
+    def check(self, purchase_id: str, admin_id: int) -> Tuple[Optional[CheckinEntry], bool]:
+        """Returns the entry and whether this scan activated it, None for an unknown ticket."""
+        with self._lock:
+            current = (self._index or {}).get(purchase_id)
+            if not current or current.activated:
+                return current, False
+
+            activation = {"id": purchase_id, "activated": datetime.now().timestamp(), "admin": admin_id}
+            # Journaled before it is confirmed, so a crash can not lose an admitted guest
+            with open(self.path, "a") as journal:
+                journal.write(json.dumps(activation) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+            self._pending.append(activation)
+            self._index[purchase_id] = current = current._replace(activated=activation["activated"])
+        return current, True
+
+    def start(self, store: StoreActivations, on_conflict: Callable[[Conflict], None] = None):
+        self._store = store
+        self._on_conflict = on_conflict
+        self._stopped.clear()
+        self._thread = Thread(target=self._work, name="offline_checkin", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        try:
+            self.sync()
+        except Exception:
+            logger.exception(f"Could not sync {self.pending} check-in activations, they stay in {self.path}")
+
+    def sync(self):
+        """Stores journaled activations batch by batch until the journal is empty."""
+        while self._store:
+            with self._lock:
+                batch = self._pending[:self.batch_size]
+            if not batch:
+                return
+
+            activations = {activation["id"]: activation["activated"] for activation in batch}
+            conflicts = self._store(activations)
+
+            found = [Conflict(purchase_id, activations[purchase_id], stored)
+                     for purchase_id, stored in conflicts.items()]
+            with self._lock:
+                # Scans made while the batch was stored are appended after it
+                self._pending = self._pending[len(batch):]
+                self._write_journal()
+                self.synced += len(batch) - len(found)
+                self.conflicts.extend(found)
+                for conflict in found:
+                    if self._index and conflict.purchase_id in self._index:
+                        self._index[conflict.purchase_id] = \
+                            self._index[conflict.purchase_id]._replace(activated=conflict.stored)
+
+            for conflict in found:
+                logger.warning(f"Ticket {conflict.purchase_id} was scanned at {conflict.activated} "
+                               f"but is activated at {conflict.stored}")
+                if self._on_conflict:
+                    self._on_conflict(conflict)
+
+    def statistics(self) -> str:
+        return f"Офлайн-регистрация: {len(self._index or {})} билетов в индексе, " \
+               f"ждут синхронизации {self.pending}, синхронизировано {self.synced}, " \
+               f"двойных проходов {len(self.conflicts)}"
+
+    def _work(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sync()
+            except Exception as e:
+                # No connection: activations stay in the journal until the next attempt
+                logger.warning(f"Check-in sync failed, {self.pending} activations wait: {e}")
+                self._stopped.wait(self.backoff)
+
+    def _read_journal(self) -> List[dict]:
+        try:
+            with open(self.path) as journal:
+                lines = journal.readlines()
+        except FileNotFoundError:
+            return []
+
+        activations = []
+        for line in lines:
+            try:
+                activations.append(json.loads(line))
+            except ValueError:
+                # A torn last line after a crash, the scan was never confirmed
+                logger.warning(f"Skipping a broken check-in journal line: {line!r}")
+        return activations
+
+    def _write_journal(self):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as journal:
+            journal.writelines(json.dumps(activation) + "\n" for activation in self._pending)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary, self.path)
+
+
+def entry(data: dict) -> CheckinEntry:
+    return CheckinEntry(helper.safe_list_get(data, "activated", None),
+                        helper.safe_list_get(data, "user_name", None) or "",
+                        helper.safe_list_get(data, "ticket_name", None) or "")
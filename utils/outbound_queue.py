@@ -0,0 +1,213 @@
+import logging
+import time
+from collections import deque
+from threading import Condition, Thread
+from typing import Callable, Deque, Dict, List, Optional
+
+from telegram import Bot, TelegramError
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower goes first
+PRIORITY_PAYMENT = 0
+PRIORITY_USER = 1
+PRIORITY_ADMIN = 2
+PRIORITY_BULK = 3
+PRIORITIES = (PRIORITY_PAYMENT, PRIORITY_USER, PRIORITY_ADMIN, PRIORITY_BULK)
+
+MAX_MESSAGE_LENGTH = 4096
+
+# Telegram allows about 30 messages per second overall and one per second per chat
+GLOBAL_RATE = 25
+CHAT_INTERVAL = 1.0
+
+Callback = Callable[[bool, Optional[Exception]], None]
+
+
+class OutboundMessage:
+    __slots__ = ("chat_id", "text", "priority", "batchable", "kwargs", "callbacks", "attempts", "not_before")
+
+    def __init__(self, chat_id: int, text: str, priority: int, batchable: bool, kwargs: dict,
+                 callback: Callback = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.batchable = batchable
+        self.kwargs = kwargs
+        self.callbacks: List[Callback] = [callback] if callback else []
+        self.attempts = 0
+        self.not_before = 0.0
+
+    def can_merge(self, other: "OutboundMessage") -> bool:
+        return other.batchable and other.chat_id == self.chat_id and other.kwargs == self.kwargs \
+               and len(self.text) + len(other.text) + 1 <= MAX_MESSAGE_LENGTH
+
+
+class OutboundQueue:
+    """Prioritized send_message queue drained by a background thread under global and per-chat rate limits."""
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_interval: float = CHAT_INTERVAL,
+                 max_attempts: int = 3, scan_limit: int = 100):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.scan_limit = scan_limit
+        self.bot: Optional[Bot] = None
+        self.sent = 0
+        self.failed = 0
+        self.batched = 0
+        self._queues: Dict[int, Deque[OutboundMessage]] = {priority: deque() for priority in PRIORITIES}
+        self._chat_ready: Dict[int, float] = {}
+        self._global_ready = 0.0
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._running = False
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._running = True
+        self._thread = Thread(target=self._run, name="outbound_queue", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def send(self, chat_id: int, text: str, priority: int = PRIORITY_USER, batchable: bool = False,
+             callback: Callback = None, **kwargs):
+        message = OutboundMessage(chat_id, text, priority, batchable, kwargs, callback)
+        if not self._thread:
+            if not self.bot:
+                raise RuntimeError("Outbound queue is not started, call outbound.start(bot) first")
+            self._deliver(message)
+            return
+
+        with self._condition:
+            self._queues[priority].append(message)
+            self._condition.notify()
+
+    def statistics(self) -> str:
+        sizes = " / ".join(str(len(self._queues[priority])) for priority in PRIORITIES)
+        return f"Очередь сообщений: {self.depth} ({sizes}), отправлено {self.sent}, " \
+               f"склеено {self.batched}, ошибок {self.failed}"
+
+    def _run(self):
+        while True:
+            with self._condition:
+                message = None
+                while self._running:
+                    now = time.monotonic()
+                    if self._global_ready > now:
+                        self._condition.wait(self._global_ready - now)
+                        continue
+
+                    message, wait = self._pop_ready(now)
+                    if message:
+                        break
+                    self._condition.wait(wait)
+
+                if not message:
+                    return
+
+                self._global_ready = time.monotonic() + self.global_interval
+                self._chat_ready[message.chat_id] = time.monotonic() + self.chat_interval
+
+            try:
+                self._deliver(message)
+            except Exception as e:
+                # A bad argument must not take down the only sender thread
+                logger.exception(f"Message to {message.chat_id} crashed the delivery")
+                self._finish(message, e)
+
+    def _pop_ready(self, now: float):
+        wait = None
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            for index in range(min(len(queue), self.scan_limit)):
+                message = queue[index]
+                ready_at = max(message.not_before, self._chat_ready.get(message.chat_id, 0.0))
+                if ready_at <= now:
+                    del queue[index]
+                    if message.batchable:
+                        self._merge_batch(message, queue, index)
+                    return message, None
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+
+        if len(self._chat_ready) > 10000:
+            self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+
+        return None, wait
+
+    def _merge_batch(self, message: OutboundMessage, queue: Deque[OutboundMessage], start: int):
+        index = start
+        while index < min(len(queue), self.scan_limit):
+            other = queue[index]
+            if message.can_merge(other):
+                message.text = f"{message.text}\n{other.text}"
+                message.callbacks.extend(other.callbacks)
+                self.batched += 1
+                del queue[index]
+            else:
+                index += 1
+
+    def _deliver(self, message: OutboundMessage):
+        message.attempts += 1
+        try:
+            self.bot.send_message(chat_id=message.chat_id, text=message.text, **message.kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Flood limit hit, pausing outbound queue for {e.retry_after}s")
+            self._retry(message, e, pause=e.retry_after)
+            return
+        except BadRequest as e:
+            # A subclass of NetworkError in PTB 13, but chat not found or broken entities stay broken
+            logger.error(f"Message to {message.chat_id} was rejected: {e}")
+            self._finish(message, e)
+            return
+        except NetworkError as e:
+            self._retry(message, e, delay=2 ** message.attempts)
+            return
+        except TelegramError as e:
+            logger.error(f"Message to {message.chat_id} was not sent: {e}")
+            self._finish(message, e)
+            return
+
+        self._finish(message)
+
+    def _retry(self, message: OutboundMessage, error: Exception, pause: float = 0, delay: float = 0):
+        if not self._thread or message.attempts >= self.max_attempts:
+            logger.error(f"Message to {message.chat_id} was not sent after {message.attempts} attempts: {error}")
+            self._finish(message, error)
+            return
+
+        with self._condition:
+            now = time.monotonic()
+            self._global_ready = max(self._global_ready, now + pause)
+            message.not_before = now + delay
+            self._queues[message.priority].appendleft(message)
+            self._condition.notify()
+
+    def _finish(self, message: OutboundMessage, error: Exception = None):
+        # Called by the sender thread and by direct deliveries before start()
+        with self._condition:
+            if error:
+                self.failed += 1
+            else:
+                self.sent += 1
+
+        for callback in message.callbacks:
+            try:
+                callback(error is None, error)
+            except Exception:
+                logger.exception("Outbound message callback failed")
+
+
+outbound = OutboundQueue()
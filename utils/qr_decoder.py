@@ -0,0 +1,72 @@
+import io
+import logging
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+try:
+    import cv2
+    import numpy
+except ImportError:  # pragma: no cover - decoding falls back to the remote service
+    cv2 = None
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Phone photos are much larger than a QR needs, detection is faster on a downscaled frame
+MAX_SIDE = 1280
+
+
+class QrDecoder:
+    """In-process QR decoding: preprocess -> detect -> decode."""
+
+    def __init__(self, max_side: int = MAX_SIDE):
+        self.max_side = max_side
+        self._detector = cv2.QRCodeDetector() if cv2 else None
+
+    @property
+    def available(self) -> bool:
+        return self._detector is not None
+
+    def decode(self, image_bytes: bytes) -> Optional[str]:
+        if not self.available:
+            return None
+
+        try:
+            gray = self.preprocess(image_bytes)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось открыть фото для распознования: {e}")
+            return None
+
+        # Second pass on a binarized frame helps with glare and low contrast screens
+        for frame in (gray, self.binarize(gray)):
+            points = self.detect(frame)
+            if points is None:
+                continue
+            code = self.decode_region(frame, points)
+            if code:
+                return code.strip()
+
+        return None
+
+    def preprocess(self, image_bytes: bytes):
+        image = Image.open(io.BytesIO(image_bytes))
+        image = ImageOps.exif_transpose(image).convert("L")
+        image.thumbnail((self.max_side, self.max_side), Image.BILINEAR)
+        image = ImageOps.autocontrast(image)
+        return numpy.asarray(image)
+
+    @staticmethod
+    def binarize(gray):
+        return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+
+    def detect(self, frame):
+        found, points = self._detector.detect(frame)
+        return points if found else None
+
+    def decode_region(self, frame, points) -> Optional[str]:
+        code, _ = self._detector.decode(frame, points)
+        return code or None
+
+
+decoder = QrDecoder()
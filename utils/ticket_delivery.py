@@ -0,0 +1,134 @@
+import logging
+import time
+from queue import Full, Queue
+from threading import Lock, Thread
+from typing import List, NamedTuple, Optional
+
+from telegram import Bot, ReplyMarkup, TelegramError
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_TIMEOUT = 50
+
+
+class DeliveryJob(NamedTuple):
+    purchase: object
+    chat_id: int
+    reply_markup: Optional[ReplyMarkup] = None
+    # Used instead of the pool's bot, for deliveries made inline
+    bot: Optional[Bot] = None
+
+
+class TicketDelivery:
+    """Bounded thread pool that renders ticket images and sends them after the handler has replied."""
+
+    def __init__(self, workers: int = 2, max_queue: int = 200, retries: int = 3, backoff: float = 2.0):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.bot: Optional[Bot] = None
+        self.delivered = 0
+        self.failed = 0
+        self._queue: Queue = Queue(maxsize=max_queue)
+        self._threads: List[Thread] = []
+        self._counters_lock = Lock()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        for index in range(self.workers):
+            thread = Thread(target=self._work, name=f"ticket_delivery_{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, purchase, chat_id: int, reply_markup: ReplyMarkup = None, bot: Bot = None):
+        job = DeliveryJob(purchase, chat_id, reply_markup, bot)
+        if not self._threads:
+            if not (bot or self.bot):
+                raise RuntimeError("Ticket delivery is not started and no bot was given")
+            return self._deliver(job)
+
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            # Under overload the handler pays for the delivery itself instead of dropping the ticket
+            logger.warning(f"Ticket delivery queue is full, sending {purchase.id} inline")
+            self._deliver(job)
+
+    def statistics(self) -> str:
+        return f"Очередь билетов: {self.depth} (отправлено {self.delivered}, ошибок {self.failed})"
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._deliver(job)
+            except Exception:
+                logger.exception("Ticket delivery crashed")
+            finally:
+                self._queue.task_done()
+
+    def send_ticket(self, purchase, chat_id: int, reply_markup: ReplyMarkup = None, bot: Bot = None):
+        """Sends the ticket image, uploading it only when the purchase has no Telegram file_id yet."""
+        bot = bot or self.bot
+        photo = purchase.photo()
+        if isinstance(photo, str):
+            try:
+                bot.send_photo(chat_id, photo=photo, reply_markup=reply_markup)
+                return
+            except BadRequest as e:
+                # The file is gone on Telegram's side (another bot token, deleted), upload it again
+                logger.warning(f"Ticket {purchase.id} file_id was rejected: {e}")
+                purchase.photo_file_id = None
+                photo = purchase.photo()
+
+        photo.seek(0)
+        message = bot.send_photo(chat_id, photo=photo, timeout=UPLOAD_TIMEOUT, reply_markup=reply_markup)
+        if message and message.photo:
+            # The largest size comes last
+            purchase.photo_file_id = message.photo[-1].file_id
+            purchase.save()
+
+    def _deliver(self, job: DeliveryJob):
+        # Inline deliveries run in the payment handler, nothing may escape into it
+        for attempt in range(1, self.retries + 1):
+            try:
+                # Chosen again on every attempt: a file_id rejected by an earlier one is gone from the purchase
+                self.send_ticket(job.purchase, job.chat_id, job.reply_markup, bot=job.bot)
+                self._count(delivered=1)
+                return
+            except RetryAfter as e:
+                time.sleep(e.retry_after)
+            except BadRequest as e:
+                # A subclass of NetworkError in PTB 13, but a rejected request stays rejected
+                logger.error(f"Ticket {job.purchase.id} was rejected for {job.chat_id}: {e}")
+                break
+            except NetworkError as e:
+                logger.warning(f"Ticket {job.purchase.id} delivery attempt {attempt} failed: {e}")
+                time.sleep(self.backoff ** attempt)
+            except TelegramError as e:
+                logger.error(f"Ticket {job.purchase.id} can not be delivered to {job.chat_id}: {e}")
+                break
+            except Exception:
+                logger.exception(f"Ticket {job.purchase.id} delivery to {job.chat_id} crashed")
+                break
+
+        self._count(failed=1)
+
+    def _count(self, delivered: int = 0, failed: int = 0):
+        with self._counters_lock:
+            self.delivered += delivered
+            self.failed += failed
@@ -0,0 +1,64 @@
+import io
+import os
+from threading import Lock
+from typing import Dict, List
+
+import pyqrcode
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+BACKGROUND_COLOR = (44, 44, 212)
+TEXT_COLOR = (255, 255, 255)
+TEXT_HEIGHT = 420
+QR_MARGIN = 30
+
+
+class TicketRenderer:
+    """Renders ticket PNGs in memory. Fonts and background templates are loaded once per process."""
+
+    def __init__(self, fonts_dir: str = "fonts", scale: int = 20, quiet_zone: int = 4):
+        self.scale = scale
+        self.quiet_zone = quiet_zone
+        self.master_font = ImageFont.FreeTypeFont(os.path.join(fonts_dir, "HelveticaBlack.ttf"), 60, encoding="utf-8")
+        self.slave_font = ImageFont.FreeTypeFont(os.path.join(fonts_dir, "arial.ttf"), 40, encoding="utf-8")
+        self._templates: Dict[int, Image.Image] = {}
+        self._templates_lock = Lock()
+
+    def qr_image(self, code: str) -> Image.Image:
+        matrix = pyqrcode.create(code).code
+        size = len(matrix)
+        modules = bytes(0 if bit else 255 for row in matrix for bit in row)
+
+        qr = Image.frombytes("L", (size, size), modules)
+        qr = ImageOps.expand(qr, border=self.quiet_zone, fill=255)
+        return qr.resize((qr.width * self.scale, qr.height * self.scale), Image.NEAREST)
+
+    def template(self, width: int) -> Image.Image:
+        # QR version depends on the code length, so there is one template per ticket width
+        template = self._templates.get(width)
+        if template:
+            return template
+
+        with self._templates_lock:
+            if width not in self._templates:
+                template = Image.new("RGB", (width, TEXT_HEIGHT + width), color=BACKGROUND_COLOR)
+                ImageDraw.Draw(template).text((50, 50), "DMM 2022", fill=TEXT_COLOR, font=self.master_font)
+                self._templates[width] = template
+            return self._templates[width]
+
+    def render(self, code: str, lines: List[str]) -> Image.Image:
+        qr = self.qr_image(code)
+        ticket = self.template(qr.width + 2 * QR_MARGIN).copy()
+
+        d = ImageDraw.Draw(ticket)
+        for index, line in enumerate(lines):
+            d.text((60, 130 + index * 50), line, fill=TEXT_COLOR, font=self.slave_font)
+
+        ticket.paste(qr, (QR_MARGIN, TEXT_HEIGHT + QR_MARGIN))
+        return ticket
+
+    def render_png(self, code: str, lines: List[str]) -> io.BytesIO:
+        buffer = io.BytesIO()
+        buffer.name = f"{code}.png"
+        self.render(code, lines).save(buffer, format="PNG")
+        buffer.seek(0)
+        return buffer
@@ -0,0 +1,55 @@
+import time
+from queue import Queue
+from threading import Lock
+from typing import List
+
+
+class UpdateQueue(Queue):
+    """Bounded queue between update ingestion and the dispatcher.
+
+    A full queue blocks the producer: polling stops fetching and the webhook answers Telegram later,
+    so a burst waits at Telegram instead of piling up in the bot's memory.
+    """
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self.received = 0
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self._stats_lock = Lock()
+
+    def put(self, item, block=True, timeout=None):
+        started = time.monotonic()
+        full = self.full()
+        super().put(item, block, timeout)
+
+        depth = self.qsize()
+        with self._stats_lock:
+            self.received += 1
+            self.max_depth = max(self.max_depth, depth)
+            if full:
+                self.blocked += 1
+                self.blocked_seconds += time.monotonic() - started
+
+    def statistics(self) -> str:
+        return f"Очередь апдейтов: {self.qsize()}/{self.maxsize} (получено {self.received}, максимум {self.max_depth}, " \
+               f"ждали места {self.blocked} раз, {round(self.blocked_seconds, 1)} с)"
+
+    def render(self) -> List[str]:
+        """Prometheus text lines."""
+        with self._stats_lock:
+            return [
+                "# TYPE dmm_update_queue_depth gauge",
+                f"dmm_update_queue_depth {self.qsize()}",
+                "# TYPE dmm_update_queue_capacity gauge",
+                f"dmm_update_queue_capacity {self.maxsize}",
+                "# TYPE dmm_update_queue_max_depth gauge",
+                f"dmm_update_queue_max_depth {self.max_depth}",
+                "# TYPE dmm_update_queue_received_total counter",
+                f"dmm_update_queue_received_total {self.received}",
+                "# TYPE dmm_update_queue_blocked_total counter",
+                f"dmm_update_queue_blocked_total {self.blocked}",
+                "# TYPE dmm_update_queue_blocked_seconds_total counter",
+                f"dmm_update_queue_blocked_seconds_total {self.blocked_seconds}",
+            ]